@@ -1,29 +1,62 @@
 # The sella/ase/tblite stack does not parallelize well for these systems.
-# Force serial execution before importing achprak or any dependency that may
-# initialize BLAS/OpenMP runtimes.
+# Default to serial execution before importing achprak or any dependency that
+# may initialize BLAS/OpenMP runtimes. Jobs raise their thread count at runtime
+# where cores are idle (see achprak.threads).
 
 import os
 
-for var in (
+THREAD_VARIABLES = (
     "OMP_NUM_THREADS",
     "OPENBLAS_NUM_THREADS",
     "MKL_NUM_THREADS",
     "VECLIB_MAXIMUM_THREADS",
     "NUMEXPR_NUM_THREADS",
-):
+)
+
+for var in THREAD_VARIABLES:
     os.environ.setdefault(var, "1")
 
-import matplotlib.pyplot as plt
+import importlib
+import warnings
+
+# Submodules are imported on first attribute access (e.g. achprak.uvvis), so
+# that `import achprak` does not pull in matplotlib, RDKit, tblite, sella or
+# nglview before they are needed.
+SUBMODULES = (
+    "azobenzene",
+    "benchmarks",
+    "broadening",
+    "cache",
+    "clipboard",
+    "common",
+    "conformers",
+    "conversion",
+    "descriptors",
+    "library",
+    "neb",
+    "optimization",
+    "scan",
+    "scheduler",
+    "screening",
+    "symmetry",
+    "threads",
+    "topology",
+    "tracing",
+    "ui",
+    "uvvis",
+    "vibrations",
+)
 
-from . import azobenzene
-from . import conversion
-from . import optimization
-from . import uvvis
 
-import warnings
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted([*globals(), *SUBMODULES])
 
-# Set plotting style.
-plt.style.use("ggplot")
 
 # Ignore the warning about log flushes, which is not relevant for this package.
 warnings.filterwarnings(
@@ -1,14 +1,25 @@
+import collections
 import contextlib
+import functools
 import io
+import threading
+import typing
 
+import ase
 import IPython.display
 import ipywidgets
 import numpy as np
 import rdkit.Chem
 import rdkit.Chem.AllChem
+import rdkit.Chem.rdMolAlign
 
-from . import common, ui
-from .clipboard import clipboard
+from . import common, descriptors, symmetry, threads, topology, ui
+from .cache import make_key, result_cache
+from .clipboard import Artifact, clipboard
+from .conformers import ConformerSearch
+from .library import library, pattern_key
+from .scheduler import JobCancelled, scheduler
+from .tracing import tracer
 
 
 class Template:
@@ -24,6 +35,7 @@ class Template:
         "SO2CF3": "(S(=O)(=O)C(F)(F)F)",
     }
 
+    @tracer.traced("Template")
     def __init__(
         self,
         configuration="trans",
@@ -37,7 +49,22 @@ class Template:
         r2c3="H",
         r2c4="H",
         r2c5="H",
+        reference=None,
     ):
+        """
+        Parameters
+        ----------
+        configuration
+            Either "trans" or "cis".
+        r1c1, ..., r2c5
+            Substituent names (keys of ``substituent_smiles``). The molecule
+            is built in the atom order of this pattern. Symmetry-equivalent
+            patterns (e.g. r1c1 and r1c5, or both rings swapped) share their
+            library entry (see symmetry.canonical).
+        reference
+            Optional previously built Template. Its embedding is reused for all
+            atoms that did not change, and the new geometry is aligned onto it.
+        """
         self.configuration = configuration
         self.substituents = [
             r1c1,
@@ -51,29 +78,48 @@ class Template:
             r2c4,
             r2c5,
         ]
+        self.key = symmetry.canonical(self.configuration, self.substituents)
+
+        cache_key = (self.configuration, tuple(self.substituents))
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            tracer.count("Template.cache_hit")
+            self.smiles, self.mol, self.molh = cached
+            if reference is not None:
+                self._align(reference)
+            self.atoms = common.mol_to_atoms(self.molh)
+            topology.register(self.molh)
+            return
+
         self.smiles = self._init_smiles()
         self.mol = self._init_mol()
         self.molh = self._init_molh()
-        self.atoms = self._init_atoms()
+        self.atoms = self._init_atoms(reference)
+        self._cache_put(cache_key, (self.smiles, self.mol, self.molh))
+        topology.register(self.molh)
+
+    # Bounded LRU cache of embedded templates, shared by all instances.
+    cache_size = 64
+    _cache: typing.ClassVar[collections.OrderedDict] = collections.OrderedDict()
+
+    @classmethod
+    def _cache_get(cls, key):
+        if key not in cls._cache:
+            return None
+        cls._cache.move_to_end(key)
+        smiles, mol, molh = cls._cache[key]
+        return smiles, mol, rdkit.Chem.Mol(molh)
+
+    @classmethod
+    def _cache_put(cls, key, value):
+        smiles, mol, molh = value
+        cls._cache[key] = (smiles, mol, rdkit.Chem.Mol(molh))
+        cls._cache.move_to_end(key)
+        while len(cls._cache) > cls.cache_size:
+            cls._cache.popitem(last=False)
 
     def _init_smiles(self) -> str:
-        smiles = ["c1"]
-        for carbon in range(5):
-            sub = self.substituents[carbon]
-            smiles.append(self.substituent_smiles[sub])
-            smiles.append("c")
-        smiles.append("1N=Nc2")
-        for carbon in range(5):
-            smiles.append("c")
-            sub = self.substituents[carbon + 5]
-            smiles.append(self.substituent_smiles[sub])
-        smiles.append("2")
-        smiles = "".join(smiles)
-
-        smiles = smiles.replace(
-            "N=N", "/N=N/" if self.configuration == "trans" else "/N=N\\"
-        )
-        return smiles
+        return template_smiles(self.configuration, self.substituents)
 
     def _init_mol(self) -> rdkit.Chem.Mol:
         mol = rdkit.Chem.MolFromSmiles(self.smiles)
@@ -84,9 +130,111 @@ class Template:
     def _init_molh(self) -> rdkit.Chem.Mol:
         return rdkit.Chem.AddHs(self.mol)
 
-    def _init_atoms(self):
+    def _init_labels(self) -> tuple:
+        return template_labels(self.configuration, tuple(self.substituents))
+
+    def _atom_map(self, reference) -> list:
+        """
+        Return (index, reference index) pairs of atoms shared with reference.
+        """
+        if reference.configuration != self.configuration:
+            return []
+        ref_indices = {label: i for i, label in enumerate(reference._init_labels())}
+        return [
+            (i, ref_indices[label])
+            for i, label in enumerate(self._init_labels())
+            if label in ref_indices
+        ]
+
+    def _align(self, reference):
+        """
+        Superimpose the shared atoms onto reference and return their RMSD.
+
+        The embedding may be the mirror image of the reference, so reflections
+        are allowed (none of the templates is chiral).
+        """
+        atom_map = self._atom_map(reference)
+        if len(atom_map) < 3:
+            return None
+        return rdkit.Chem.rdMolAlign.AlignMol(
+            self.molh, reference.molh, atomMap=atom_map, reflect=True
+        )
+
+    def _embed_incremental(self, reference) -> bool:
+        """
+        Embed only the atoms that differ from reference, keeping the others fixed.
+
+        The molecule is embedded with the shared heavy atoms constrained to
+        their reference positions and superimposed onto them. Then all shared
+        atoms are put back exactly in place, and only the new atoms are relaxed
+        with MMFF.
+        """
+        atom_map = self._atom_map(reference)
+        heavy_map = [
+            (i, j)
+            for i, j in atom_map
+            if self.molh.GetAtomWithIdx(i).GetAtomicNum() > 1
+        ]
+        if len(heavy_map) < 3:
+            return False
+
+        # Hydrogens are left out of the coordinate map: constraining all atoms
+        # of a ring next to a new substituent often makes the embedding fail.
+        ref_conf = reference.molh.GetConformer()
+        coord_map = {i: ref_conf.GetAtomPosition(j) for i, j in heavy_map}
+        rc = rdkit.Chem.AllChem.EmbedMolecule(
+            self.molh,
+            coordMap=coord_map,
+            randomSeed=42,
+            useRandomCoords=True,
+            useExpTorsionAnglePrefs=True,
+            useBasicKnowledge=True,
+            ETversion=2,
+        )
+        if rc != 0:
+            return False
+        # The coordinate map only constrains distances, so the embedding may be
+        # rotated or mirrored.
+        rdkit.Chem.rdMolAlign.AlignMol(
+            self.molh, reference.molh, atomMap=heavy_map, reflect=True
+        )
+
+        conf = self.molh.GetConformer()
+        for i, j in atom_map:
+            conf.SetAtomPosition(i, ref_conf.GetAtomPosition(j))
+
+        mp = rdkit.Chem.AllChem.MMFFGetMoleculeProperties(
+            self.molh, mmffVariant="MMFF94s"
+        )
+        ff = rdkit.Chem.AllChem.MMFFGetMoleculeForceField(self.molh, mp)
+        if ff is None:
+            tracer.count("Template.incremental_rejected")
+            self.molh.RemoveAllConformers()
+            return False
+        for i, _ in atom_map:
+            ff.AddFixedPoint(i)
+        ff.Minimize()
+        return True
+
+    def _init_atoms(self, reference=None):
         mol = self.molh
 
+        if reference is not None and self._embed_incremental(reference):
+            return common.mol_to_atoms(mol)
+
+        # Use the stored embedding of precomputed patterns (which is in the
+        # atom order of the canonical pattern).
+        entry = library.get(pattern_key(*self.key))
+        if entry is not None and len(entry["numbers"]) == mol.GetNumAtoms():
+            perm = template_permutation(*self.key, self.substituents)
+            conf = rdkit.Chem.Conformer(mol.GetNumAtoms())
+            conf.SetPositions(entry["initial_positions"][perm])
+            conf.Set3D(True)
+            mol.AddConformer(conf, assignId=True)
+            if reference is not None:
+                self._align(reference)
+            return common.mol_to_atoms(mol)
+
         # ETKDG first, then fallback embedding.
         params = rdkit.Chem.AllChem.ETKDGv3()
         params.randomSeed = 42
@@ -96,8 +244,121 @@ class Template:
         if rc != 0:
             raise RuntimeError("RDKit 3D embedding failed for generated molecule.")
 
+        if reference is not None:
+            self._align(reference)
+
         return common.mol_to_atoms(mol)
 
+    def search_conformers(self, **kwargs):
+        """
+        Replace the embedded geometry by the best conformer of a conformer search.
+
+        Keyword arguments are passed to conformers.ConformerSearch. Returns the
+        search, which also provides the remaining ensemble.
+        """
+        search = ConformerSearch(self.molh, **kwargs)
+        best = search.run()
+
+        conf = self.molh.GetConformer()
+        for i, position in enumerate(best.positions):
+            conf.SetAtomPosition(i, position.tolist())
+        self.atoms = common.mol_to_atoms(self.molh)
+        return search
+
+
+def template_smiles(configuration, substituents) -> str:
+    """
+    Return the SMILES of a substitution pattern (in the atom order of Template).
+    """
+    smiles = ["c1"]
+    for carbon in range(5):
+        sub = substituents[carbon]
+        smiles.append(Template.substituent_smiles[sub])
+        smiles.append("c")
+    smiles.append("1N=Nc2")
+    for carbon in range(5):
+        smiles.append("c")
+        sub = substituents[carbon + 5]
+        smiles.append(Template.substituent_smiles[sub])
+    smiles.append("2")
+    smiles = "".join(smiles)
+
+    smiles = smiles.replace("N=N", "/N=N/" if configuration == "trans" else "/N=N\\")
+    return smiles
+
+
+@functools.lru_cache(maxsize=256)
+def template_labels(configuration, substituents) -> tuple:
+    """
+    Label every atom of a template (substituents given as a tuple) by its role.
+
+    Labels mirror the atom order produced by template_smiles (heavy atoms) and
+    AddHs (hydrogens, appended in order of their parents). Atoms carrying the
+    same label in two templates occupy the same place in the molecule.
+    """
+
+    def substituent(slot):
+        sub = substituents[slot]
+        smiles = Template.substituent_smiles[sub][1:-1]
+        if not smiles:
+            return []
+        natoms = rdkit.Chem.MolFromSmiles(smiles).GetNumAtoms()
+        return [("sub", slot, sub, k) for k in range(natoms)]
+
+    # Ring carbons are labeled by their slot; substituents are branches on them.
+    labels = []
+    for slot in range(5):
+        labels.append(("C", slot))
+        labels.extend(substituent(slot))
+    labels.extend([("ipso", 0), ("N", 0), ("N", 1), ("ipso", 1)])
+    for slot in range(5, 10):
+        labels.append(("C", slot))
+        labels.extend(substituent(slot))
+
+    molh = rdkit.Chem.AddHs(
+        rdkit.Chem.MolFromSmiles(template_smiles(configuration, substituents))
+    )
+    counts = collections.Counter()
+    for i in range(len(labels), molh.GetNumAtoms()):
+        parent = labels[molh.GetAtomWithIdx(i).GetNeighbors()[0].GetIdx()]
+        labels.append(("H", parent, counts[parent]))
+        counts[parent] += 1
+    return tuple(labels)
+
+
+def template_permutation(configuration, source, target) -> np.ndarray:
+    """
+    Return the atom permutation between the templates of two symmetry-equivalent
+    patterns: positions[perm] takes positions of the source template to the
+    atom order of the target template.
+
+    Raises
+    ------
+    ValueError
+        If the patterns are not equivalent.
+    """
+    source, target = tuple(source), tuple(target)
+    for op in symmetry.OPERATIONS:
+        if tuple(source[i] for i in op) == target:
+            break
+    else:
+        raise ValueError(f"{source} and {target} are not equivalent.")
+
+    # Slot i of the target is slot op[i] of the source (see symmetry.OPERATIONS),
+    # and rings are mapped as a whole.
+    def image(label):
+        kind = label[0]
+        if kind == "H":
+            return ("H", image(label[1]), label[2])
+        if kind in ("C", "sub"):
+            return (kind, op[label[1]], *label[2:])
+        return (kind, op[5 * label[1]] // 5)
+
+    index = {label: i for i, label in enumerate(template_labels(configuration, source))}
+    return np.array(
+        [index[image(label)] for label in template_labels(configuration, target)]
+    )
+
 
 class TemplateTool:
     """Interactive tool for creating an azobenzene template."""
@@ -170,70 +431,171 @@ class TemplateTool:
             for carbon in range(5):
                 key = f"r{ring + 1}c{carbon + 1}"
                 kwargs[key] = self._substituent_dropdowns[ring * 5 + carbon].value
-        self.template = Template(**kwargs)
+        self.template = Template(**kwargs, reference=self.template)
 
     def _on_click(self, button):
         if button is self._copy_button:
-            xyz = common.atoms_to_xyz(self.template.atoms)
-            clipboard.copy(xyz)
+            artifact = Artifact(
+                self.template.atoms, mol=self.template.molh, source="TemplateTool"
+            )
+            clipboard.copy(artifact)
             ui.flash_button(button, message=common.COPY_OK_TEXT)
 
 
 class Properties:
     """Compute selected properties of an azobenzene derivative."""
 
-    def __init__(self, atoms):
+    def __init__(self, atoms, cache=True):
+        """
+        Parameters
+        ----------
+        atoms
+            ASE Atoms object.
+        cache
+            Whether to use the result cache. One-off structures (e.g. frames
+            of a trajectory) should bypass it, so that they do not evict useful
+            entries.
+        """
         self.atoms = atoms
-        self.atoms.calc = common.DefaultASECalculator()
+        self.atoms.calc = common.pooled_calculator()
         self.mol = common.atoms_to_mol(atoms)
-
-    def _find_azo_bond(self):
-        for bond in self.mol.GetBonds():
-            a = bond.GetBeginAtom()
-            b = bond.GetEndAtom()
-            if (
-                a.GetSymbol() == "N"
-                and b.GetSymbol() == "N"
-                and bond.GetBondType().name == "DOUBLE"
-            ):
-                return a.GetIdx(), b.GetIdx()
-        return None
-
-    def _find_carbon_neighbor(self, i):
-        for nbr in self.mol.GetAtomWithIdx(i).GetNeighbors():
-            if nbr.GetSymbol() == "C":
-                return nbr.GetIdx()
-        return None
-
-    def cnnc_dihedral_indices(self):
-        azo = self._find_azo_bond()
-        if azo is None:
-            raise ValueError("Could not find azo N=N double bond in molecule.")
-        n1, n2 = azo
-
-        c1 = self._find_carbon_neighbor(n1)
-        c2 = self._find_carbon_neighbor(n2)
-        if c1 is None or c2 is None:
-            raise ValueError(
-                "Could not find carbon neighbors adjacent to azo nitrogens."
+        self.cache = cache
+        self._descriptors = None
+        self._last = None  # positions and results of the last single point
+
+    @property
+    def descriptors(self):
+        if self._descriptors is None:
+            self._descriptors = descriptors.Descriptors(
+                self.mol, self.atoms.get_masses()
             )
+        return self._descriptors
 
-        return [c1, n1, n2, c2]
+    def cnnc_dihedral_indices(self):
+        return list(self.descriptors.cnnc)
 
     def cnnc_dihedral(self):
-        return self.atoms.get_dihedral(*self.cnnc_dihedral_indices())
+        return float(self.descriptors.compute(self.atoms.positions)["cnnc_dihedral"])
 
     def ring_distance(self):
-        rings = self.mol.GetRingInfo().AtomRings()
-        if len(rings) < 2:
-            raise ValueError("Expected at least two rings in azobenzene.")
-        com1 = self.atoms[rings[0]].get_center_of_mass()
-        com2 = self.atoms[rings[1]].get_center_of_mass()
-        return np.linalg.norm(com1 - com2) * 100.0  # pm
-
+        return float(self.descriptors.compute(self.atoms.positions)["ring_distance"])
+
+    def _single_point(self):
+        positions = self.atoms.get_positions()
+        if self._last is not None and np.array_equal(self._last[0], positions):
+            return self._last[1]
+
+        key = make_key("energy", self.atoms, self.atoms.calc)
+        entry = result_cache.get(key) if self.cache else None
+        if entry is not None and "forces" in entry:
+            return entry
+
+        # The calculator may be shared with other threads, so energy and forces
+        # must be taken from the same calculation.
+        with (
+            contextlib.redirect_stdout(io.StringIO()),
+            threads.limit(threads.job_threads("tblite")),
+        ):
+            arrays = self.atoms.calc.get_results(self.atoms)  # eV, eV/Å
+        if self.cache:
+            result_cache.put(key, **arrays)
+        self._last = (positions, arrays)
+        return arrays
+
+    @tracer.traced("Properties.energy")
     def energy(self):
-        with contextlib.redirect_stdout(io.StringIO()):
-            return self.atoms.get_potential_energy()  # eV
+        return float(self._single_point()["energy"])  # eV
+
+    def forces(self):
+        return np.asarray(self._single_point()["forces"])  # eV/Å
+
+
+# Columns returned by batch_properties.
+BATCH_COLUMNS = ("energy", "forces", "cnnc_dihedral", "ring_distance")
+
+
+def _batch_chunk(numbers, positions):
+    """
+    Worker: properties of consecutive structures of the same atoms.
+
+    The pooled calculator of this process is reused, so that every SCC starts
+    from the wavefunction of the previous structure, and the topology is only
+    perceived once per connectivity.
+    """
+    atoms = ase.Atoms(numbers=numbers, positions=positions[0])
+    by_fingerprint = {}
+    frames = collections.defaultdict(list)  # fingerprint -> frame indices
+    energies = []
+    forces = []
+    for i, pos in enumerate(positions):
+        atoms.positions[:] = pos
+        bonds = topology.connectivity(numbers, pos)
+        key = topology.fingerprint(numbers, bonds)
+        properties = by_fingerprint.get(key)
+        if properties is None:
+            properties = by_fingerprint[key] = Properties(atoms, cache=False)
+        frames[key].append(i)
+        energies.append(properties.energy())
+        forces.append(properties.forces())
+
+    columns = {
+        "energy": np.array(energies),
+        "forces": np.array(forces),
+        "cnnc_dihedral": np.empty(len(positions)),
+        "ring_distance": np.empty(len(positions)),
+    }
+    for key, indices in frames.items():
+        values = by_fingerprint[key].descriptors.compute(positions[indices])
+        columns["cnnc_dihedral"][indices] = values["cnnc_dihedral"]
+        columns["ring_distance"][indices] = values["ring_distance"]
+    return columns
+
+
+@tracer.traced("batch_properties")
+def batch_properties(images, max_workers=None):
+    """
+    Compute the properties of many structures, e.g. an optimization
+    trajectory (OptMin.traj) or a conformer ensemble.
+
+    Parameters
+    ----------
+    images
+        List of ASE Atoms objects with the same atoms in the same order.
+    max_workers
+        Number of processes to use. With None, the shared process pool is
+        used; with 1, the structures are computed in this process.
+
+    Returns
+    -------
+    dict
+        Arrays of energies (eV), forces (eV/Å), CNNC dihedrals (°) and ring
+        distances (pm), one row per structure (see BATCH_COLUMNS).
+    """
+    if len(images) == 0:
+        raise ValueError("No structures given.")
+    numbers = images[0].get_atomic_numbers()
+    for atoms in images:
+        if not np.array_equal(atoms.get_atomic_numbers(), numbers):
+            raise ValueError("All structures must have the same atoms.")
+    positions = np.array([atoms.get_positions() for atoms in images])
+
+    if max_workers == 1:
+        return _batch_chunk(numbers, positions)
+
+    with common.process_pool(max_workers) as (pool, nworkers):
+        # Consecutive structures stay within a chunk, so that each worker
+        # walks through nearby geometries.
+        chunks = [
+            chunk
+            for chunk in np.array_split(positions, min(nworkers, len(positions)))
+            if len(chunk) > 0
+        ]
+        futures = [pool.submit(_batch_chunk, numbers, chunk) for chunk in chunks]
+        results = [future.result() for future in futures]
+    return {
+        name: np.concatenate([result[name] for result in results])
+        for name in BATCH_COLUMNS
+    }
 
 
 class PropertiesTool:
@@ -242,6 +604,11 @@ class PropertiesTool:
     def __init__(self):
         self.atoms = None
         self.properties = None
+        # Background worker, its cancellation flag, and a lock so that a
+        # reset does not interleave with the worker reporting its outcome.
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
 
         self._xyz_output = ipywidgets.Output()
         self._ngl_accordion = ui.NGLAccordion()
@@ -280,6 +647,7 @@ class PropertiesTool:
         )
 
     def _reset(self):
+        self._cancel()
         self.atoms = None
         self.properties = None
         self._xyz_output.clear_output()
@@ -303,16 +671,103 @@ class PropertiesTool:
                 self._run_button.disabled = False
 
         elif button is self._run_button:
-            self._run_button.disabled = True
-            self._run_button.description = common.RUN_START_TEXT + "…"
-            try:
-                self.properties = Properties(self.atoms)
-                self._update()
+            if self._thread is not None:
+                # The run button doubles as a cancel button while queued.
+                self._stop.set()
+                self._run_button.disabled = True
+                self._run_button.description = common.RUN_CANCELLING_TEXT
+                return
+
+            self.properties = Properties(self.atoms)
+            energy = self._lookup()
+            if energy is not None:
+                self._update(energy)
                 self._run_button.description = common.RUN_OK_TEXT
-            finally:
-                self._run_button.disabled = False
+            else:
+                self._start()
+
+    def _lookup(self):
+        """
+        Return the energy from the substituent library or the result cache
+        (or None), so that known structures do not wait in the queue.
+        """
+        if library.compatible(self.atoms.calc):
+            entry = library.find(self.atoms, exact=True)
+            if entry is not None:
+                return entry["energy"]
+        entry = result_cache.get(make_key("energy", self.atoms, self.atoms.calc))
+        if entry is not None:
+            return float(entry["energy"])
+        return None
+
+    def _start(self):
+        """
+        Start the calculation in a background thread.
+        """
+        self._stop = threading.Event()
+        self._run_button.description = common.RUN_CANCEL_TEXT
+        self._thread = threading.Thread(
+            target=self._work, args=(self._stop, self.properties), daemon=True
+        )
+        self._thread.start()
+
+    def _cancel(self):
+        """
+        Leave the queue and detach the worker.
+
+        The worker is not waited for, since a single point cannot be
+        interrupted. It finishes on its own, and its result is dropped.
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._stop.set()
+                self._thread = None
+
+    def _work(self, stop, properties):
+        """
+        Worker thread: wait for a free slot, then calculate the energy, and
+        report it unless the tool was reset in the meantime.
+        """
+        energy = None
+        try:
+            on_wait = functools.partial(self._on_queue, stop)
+            with scheduler.slot("PropertiesTool", on_wait=on_wait, stop=stop):
+                if stop.is_set():
+                    raise JobCancelled()
+                with self._lock:
+                    if self._thread is threading.current_thread():
+                        # The single point cannot be interrupted.
+                        self._run_button.disabled = True
+                        self._run_button.description = common.RUN_RUNNING_TEXT
+                energy = properties.energy()
+        except JobCancelled:
+            pass
+        except BaseException:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._run_button.description = common.RUN_ERROR_TEXT
+                    self._run_button.disabled = False
+                    self._thread = None
+            raise
+
+        with self._lock:
+            if self._thread is not threading.current_thread():
+                return
+            self._thread = None
+            if energy is None:
+                self._run_button.description = common.RUN_START_TEXT
+            else:
+                self._update(energy)
+                self._run_button.description = common.RUN_OK_TEXT
+            self._run_button.disabled = False
+
+    def _on_queue(self, stop, position):
+        if not stop.is_set():
+            self._run_button.description = common.RUN_QUEUED_TEXT.format(
+                position=position
+            )
 
-    def _update(self):
-        self._energy_text.value = f"{self.properties.energy():.4f}"
+    def _update(self, energy):
+        self._energy_text.value = f"{energy:.4f}"
         self._cnnc_dihedral_text.value = f"{self.properties.cnnc_dihedral():.1f}"
         self._ring_distance_text.value = f"{self.properties.ring_distance():.1f}"
@@ -0,0 +1,469 @@
+"""Benchmarks for tracking the performance of achprak over time."""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+IMPORT_REPEAT = 3
+
+# Fixed set of substituent patterns (Template keyword arguments), from the
+# parent compound to push-pull and ortho-substituted derivatives. Names use the
+# numbering of the TemplateTool (r1c3 is C4).
+PATTERNS = {
+    "H": {},
+    "4-Me": {"r1c3": "Me"},
+    "4,4'-OMe": {"r1c3": "OMe", "r2c3": "OMe"},
+    "2,6-F": {"r1c1": "F", "r1c5": "F"},
+    "4-NMe2-4'-SO2CF3": {"r1c3": "NMe2", "r2c3": "SO2CF3"},
+    "cis-4-CF3": {"configuration": "cis", "r1c3": "CF3"},
+}
+
+STAGES = (
+    "embedding",
+    "perception",
+    "scc",
+    "sella",
+    "vibrations",
+    "mopac",
+    "parsing",
+)
+
+# Number of Sella steps per pattern. Optimizations are not run to convergence,
+# so that the cost per step is comparable between runs.
+SELLA_STEPS = 10
+
+# A stage regresses if it becomes slower than the baseline by more than the
+# relative TOLERANCE and by more than MIN_TIME seconds (to ignore jitter).
+TOLERANCE = 0.2
+MIN_TIME = 0.05
+
+# Run in a fresh interpreter, so that nothing is imported (or cached) yet.
+_IMPORT_SCRIPT = """
+import json, resource, sys, time
+t0 = time.perf_counter()
+import {module}
+wall = time.perf_counter() - t0
+# ru_maxrss is in KiB on Linux, but in bytes on macOS.
+scale = 1 if sys.platform == "darwin" else 1024
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+print(json.dumps({{"wall": wall, "max_rss": rss}}))
+"""
+
+
+def _import_once(module):
+    proc = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT.format(module=module)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def import_time(modules=None, repeat=IMPORT_REPEAT):
+    """
+    Measure the cost of importing achprak and its submodules.
+
+    Every import runs in a fresh interpreter, so the numbers include loading
+    all (heavy) dependencies, as on kernel startup.
+
+    Parameters
+    ----------
+    modules
+        Module names to import (default: achprak and all its submodules).
+    repeat
+        Number of runs per module; the fastest wall time is reported.
+
+    Returns
+    -------
+    dict
+        Wall time (in s) and peak resident memory (in MB) per module.
+    """
+    if modules is None:
+        import achprak
+
+        modules = ["achprak"] + [f"achprak.{name}" for name in achprak.SUBMODULES]
+
+    results = {}
+    for module in modules:
+        runs = [_import_once(module) for _ in range(repeat)]
+        results[module] = {
+            "wall": min(run["wall"] for run in runs),
+            "max_rss": max(run["max_rss"] for run in runs) / 1e6,
+        }
+    return results
+
+
+def _max_rss():
+    """
+    Return the peak resident memory (in MB) of this process and of its
+    terminated child processes (e.g. MOPAC).
+    """
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"self": own * scale / 1e6, "children": children * scale / 1e6}
+
+
+@contextlib.contextmanager
+def _stage(stages, name):
+    """
+    Time a stage and record it in stages. The yielded record may be updated
+    with the number of calls (count) the stage performed.
+    """
+    record = {"count": 1}
+    start = time.perf_counter()
+    yield record
+    record["time"] = time.perf_counter() - start
+    record["max_rss"] = _max_rss()
+    stages[name] = record
+
+
+def _run_pattern(kwargs, sella_steps, mopac, max_workers):
+    import sella
+
+    from . import azobenzene, common, optimization, topology, uvvis
+    from .vibrations import ParallelVibrations
+
+    stages = {}
+
+    # Embed from scratch, not from the template cache.
+    azobenzene.Template._cache.clear()
+    with _stage(stages, "embedding"):
+        template = azobenzene.Template(**kwargs)
+    atoms = template.atoms.copy()
+    indices = azobenzene.Properties(atoms.copy()).cnnc_dihedral_indices()
+
+    # Full bond perception, bypassing the topology cache.
+    with _stage(stages, "perception"):
+        numbers = atoms.get_atomic_numbers()
+        positions = atoms.get_positions()
+        bonds = topology.connectivity(numbers, positions)
+        topology._perceive(numbers, positions, bonds, 0)
+
+    # A fresh calculator, so that the first SCC starts without a warm start.
+    atoms.calc = common.DefaultASECalculator()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with _stage(stages, "scc"):
+            atoms.get_potential_energy()
+            atoms.get_forces()
+
+        with _stage(stages, "sella") as record:
+            opt = sella.Sella(atoms, order=0, internal=True, logfile=None)
+            for _ in opt.irun(fmax=optimization.FMAX, steps=sella_steps):
+                pass
+            record["count"] = opt.nsteps
+
+    with _stage(stages, "vibrations") as record:
+        vibrations = ParallelVibrations(atoms, indices=indices, max_workers=max_workers)
+        vibrations.run()
+        record["count"] = 6 * len(indices)
+
+    if mopac:
+        with tempfile.TemporaryDirectory(prefix="achprak-benchmark-") as tmp:
+            with open(os.path.join(tmp, "job.mop"), "w") as f:
+                f.write(uvvis.mopac_input(atoms))
+            with _stage(stages, "mopac"):
+                subprocess.run(
+                    [uvvis.MOPAC_EXECUTABLE, "job.mop"],
+                    cwd=tmp,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    check=True,
+                )
+            with _stage(stages, "parsing") as record:
+                excitations, _ = uvvis.parse_mopac_excitations(
+                    os.path.join(tmp, "job.out")
+                )
+                record["count"] = len(excitations)
+
+    return stages
+
+
+def suite(patterns=None, sella_steps=SELLA_STEPS, mopac=None, max_workers=None):
+    """
+    Run the benchmark suite and time every stage of the pipeline separately.
+
+    For every substituent pattern, the template is embedded, its bonds are
+    perceived, and a single point, a few Sella steps, a CNNC vibrational
+    analysis and a MOPAC INDO/CIS calculation are run. The result cache is
+    disabled while the suite runs.
+
+    Parameters
+    ----------
+    patterns
+        Dict of name and Template keyword arguments (default: PATTERNS).
+    sella_steps
+        Number of Sella steps per pattern.
+    mopac
+        Whether to run MOPAC (default: if the executable is available).
+    max_workers
+        Number of processes for the vibrations (None uses the shared pool;
+        the first pattern then includes the pool startup).
+
+    Returns
+    -------
+    dict
+        JSON-serializable results: metadata, and per pattern the wall time,
+        count and peak memory (in MB) after each stage.
+    """
+    from . import common, uvvis
+    from .cache import result_cache
+
+    if patterns is None:
+        patterns = PATTERNS
+    if mopac is None:
+        mopac = shutil.which(uvvis.MOPAC_EXECUTABLE) is not None
+
+    results = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "sella_steps": sella_steps,
+            "mopac": mopac,
+        },
+        "patterns": {},
+    }
+
+    enabled = result_cache.enabled
+    result_cache.enabled = False
+    try:
+        for name, kwargs in patterns.items():
+            start = time.perf_counter()
+            try:
+                stages = _run_pattern(kwargs, sella_steps, mopac, max_workers)
+            except common.CALCULATION_ERRORS as e:
+                # A failing pattern is recorded; anything else is a bug.
+                results["patterns"][name] = {"error": repr(e)}
+                continue
+            results["patterns"][name] = {
+                "time": time.perf_counter() - start,
+                "stages": stages,
+            }
+    finally:
+        result_cache.enabled = enabled
+
+    results["max_rss"] = _max_rss()
+    return results
+
+
+def thread_scaling(pattern="4-NMe2-4'-SO2CF3", counts=None, repeat=3, mopac=None):
+    """
+    Time a single point (tblite) and a MOPAC run for different thread counts.
+
+    Parameters
+    ----------
+    pattern
+        Name of the substituent pattern (key of PATTERNS).
+    counts
+        Thread counts (default: powers of two up to the available cores).
+    repeat
+        Number of runs per thread count; the fastest is reported.
+    mopac
+        Whether to run MOPAC (default: if the executable is available).
+
+    Returns
+    -------
+    dict
+        Wall time (in s) per program and thread count.
+    """
+    from . import azobenzene, common, threads, uvvis
+    from .cache import result_cache
+
+    if counts is None:
+        counts = [1]
+        while counts[-1] * 2 <= threads.available_cpus():
+            counts.append(counts[-1] * 2)
+    if mopac is None:
+        mopac = shutil.which(uvvis.MOPAC_EXECUTABLE) is not None
+
+    atoms = azobenzene.Template(**PATTERNS[pattern]).atoms
+    results = {"tblite": {}, "mopac": {}}
+
+    enabled = result_cache.enabled
+    result_cache.enabled = False
+    try:
+        for n in counts:
+            times = []
+            for _ in range(repeat):
+                # A fresh calculator, so that every SCC starts from scratch.
+                trial = atoms.copy()
+                trial.calc = common.DefaultASECalculator()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()), threads.limit(n):
+                    trial.get_forces()
+                times.append(time.perf_counter() - start)
+            results["tblite"][n] = min(times)
+
+            if mopac:
+                times = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    uvvis.run_mopac(atoms, nthreads=n)
+                    times.append(time.perf_counter() - start)
+                results["mopac"][n] = min(times)
+    finally:
+        result_cache.enabled = enabled
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE, min_time=MIN_TIME):
+    """
+    Compare suite results against a baseline.
+
+    Parameters
+    ----------
+    results, baseline
+        Return values of suite (e.g. loaded from JSON).
+    tolerance
+        Allowed relative increase of times and peak memory.
+    min_time
+        Time differences (in s) below this are never regressions.
+
+    Returns
+    -------
+    list
+        One dict (pattern, stage, baseline, value, ratio) per regression.
+        Stage None refers to the peak memory of the whole run.
+    """
+    regressions = []
+
+    def check(pattern, stage, old, new, min_diff):
+        if old > 0 and new > old * (1.0 + tolerance) and new - old > min_diff:
+            regressions.append(
+                {
+                    "pattern": pattern,
+                    "stage": stage,
+                    "baseline": old,
+                    "value": new,
+                    "ratio": new / old,
+                }
+            )
+
+    for pattern, entry in results["patterns"].items():
+        old_entry = baseline["patterns"].get(pattern, {})
+        if "stages" not in entry or "stages" not in old_entry:
+            continue
+        for stage, record in entry["stages"].items():
+            old = old_entry["stages"].get(stage)
+            if old is not None:
+                check(pattern, stage, old["time"], record["time"], min_time)
+
+    if "max_rss" in results and "max_rss" in baseline:
+        check(None, None, baseline["max_rss"]["self"], results["max_rss"]["self"], 0)
+    return regressions
+
+
+def report(results, regressions=()):
+    """
+    Format suite results (and regressions) as a table.
+    """
+    lines = [f"{'pattern':<20}" + "".join(f"{stage:>12}" for stage in STAGES)]
+    for pattern, entry in results["patterns"].items():
+        if "error" in entry:
+            lines.append(f"{pattern:<20}  {entry['error']}")
+            continue
+        cells = []
+        for stage in STAGES:
+            record = entry["stages"].get(stage)
+            cells.append(f"{record['time']:11.3f}s" if record else f"{'-':>12}")
+        lines.append(f"{pattern:<20}" + "".join(cells))
+    lines.append(f"Peak memory: {results['max_rss']['self']:.1f} MB")
+
+    for r in regressions:
+        if r["stage"] is None:
+            what = "peak memory"
+        else:
+            what = f"{r['pattern']}/{r['stage']}"
+        lines.append(
+            f"REGRESSION {what}: {r['baseline']:.3f} -> {r['value']:.3f} "
+            f"({r['ratio']:.2f}x)"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m achprak.benchmarks", description=__doc__
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    imports = commands.add_parser("imports", help="time importing the package")
+    imports.add_argument("modules", nargs="*", help="modules to import")
+    imports.add_argument("--repeat", type=int, default=IMPORT_REPEAT)
+    imports.add_argument("--json", action="store_true", help="print JSON")
+
+    run = commands.add_parser("suite", help="run the per-stage benchmark suite")
+    run.add_argument("patterns", nargs="*", help=f"subset of {list(PATTERNS)}")
+    run.add_argument("--sella-steps", type=int, default=SELLA_STEPS)
+    run.add_argument("--no-mopac", action="store_true", help="skip MOPAC")
+    run.add_argument("--max-workers", type=int, default=None)
+    run.add_argument("--output", help="write the results to this JSON file")
+    run.add_argument("--baseline", help="compare against this JSON file")
+    run.add_argument("--tolerance", type=float, default=TOLERANCE)
+
+    scaling = commands.add_parser("threads", help="time different thread counts")
+    scaling.add_argument("pattern", nargs="?", default="4-NMe2-4'-SO2CF3")
+    scaling.add_argument("--counts", type=int, nargs="+")
+    scaling.add_argument("--repeat", type=int, default=3)
+    scaling.add_argument("--no-mopac", action="store_true", help="skip MOPAC")
+    args = parser.parse_args(argv)
+
+    if args.command == "imports":
+        results = import_time(args.modules or None, repeat=args.repeat)
+        if args.json:
+            print(json.dumps(results, indent=2))
+            return 0
+        for module, result in results.items():
+            print(f"{module:<24} {result['wall']:8.3f} s {result['max_rss']:8.1f} MB")
+        return 0
+
+    if args.command == "threads":
+        results = thread_scaling(
+            args.pattern,
+            counts=args.counts,
+            repeat=args.repeat,
+            mopac=False if args.no_mopac else None,
+        )
+        for program, times in results.items():
+            for n, t in times.items():
+                speedup = times[min(times)] / t
+                print(f"{program:<8} {n:4d} threads {t:8.3f} s {speedup:6.2f}x")
+        return 0
+
+    patterns = PATTERNS
+    if args.patterns:
+        patterns = {name: PATTERNS[name] for name in args.patterns}
+    results = suite(
+        patterns,
+        sella_steps=args.sella_steps,
+        mopac=False if args.no_mopac else None,
+        max_workers=args.max_workers,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+    print(report(results, regressions))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Vectorized broadening of many stick spectra at once."""
+
+import functools
+
+import numpy as np
+import scipy.constants as const
+import scipy.sparse
+
+HC = const.Planck * const.speed_of_light / (const.electron_volt * const.nano)  # eV nm
+
+# Number of peaks whose line shapes are evaluated in one block. Bounds the
+# temporary (peaks × grid) array to a few tens of MB.
+CHUNK_SIZE = 4096
+
+FWHM_PER_SIGMA = 2.0 * np.sqrt(2.0 * np.log(2.0))
+
+
+def _gaussian(x, sigma):
+    return np.exp(-0.5 * (x / sigma) ** 2)
+
+
+def _lorentzian(x, sigma):
+    # Same FWHM as a Gaussian with the given sigma.
+    gamma = 0.5 * FWHM_PER_SIGMA * sigma
+    return gamma**2 / (x**2 + gamma**2)
+
+
+def _pseudo_voigt(x, sigma, eta):
+    return eta * _lorentzian(x, sigma) + (1.0 - eta) * _gaussian(x, sigma)
+
+
+def _flatten(energies, strengths):
+    """
+    Flatten ragged stick spectra into peak arrays plus the spectrum index of
+    every peak.
+    """
+    if len(energies) != len(strengths):
+        raise ValueError("Expected as many strength arrays as energy arrays.")
+    lengths = [len(e) for e in energies]
+    for e, f in zip(energies, strengths):
+        if len(e) != len(f):
+            raise ValueError("Energies and strengths of a spectrum differ in length.")
+    index = np.repeat(np.arange(len(energies)), lengths)
+    if len(index) == 0:
+        return np.empty(0), np.empty(0), index
+    e = np.concatenate([np.asarray(e, dtype=np.float64) for e in energies])
+    f = np.concatenate([np.asarray(f, dtype=np.float64) for f in strengths])
+    return e, f, index
+
+
+def broaden(
+    energies,
+    strengths,
+    grid=None,
+    lineshape="gaussian",
+    sigma=0.3,
+    eta=0.5,
+    unit="eV",
+):
+    """
+    Broaden stick spectra into continuous spectra.
+
+    Line shapes are normalized to unit height, so that an isolated peak has
+    the height of its oscillator strength. Broadening is always done in energy;
+    with unit="nm", the spectra are sampled on a wavelength grid.
+
+    Parameters
+    ----------
+    energies
+        Sequence of 1-D arrays of excitation energies in eV (may be ragged).
+    strengths
+        Sequence of 1-D arrays of oscillator strengths, matching energies.
+    grid
+        1-D grid in eV or nm (defaults to 1000 points between 1.5 and 5.5 eV,
+        or the corresponding wavelengths).
+    lineshape
+        "gaussian", "lorentzian" or "pseudo-voigt".
+    sigma
+        Gaussian standard deviation in eV. Lorentzians use the same FWHM.
+    eta
+        Lorentzian fraction of the pseudo-Voigt profile.
+    unit
+        Unit of the grid, "eV" or "nm".
+
+    Returns
+    -------
+    grid, spectra
+        The grid and a 2-D array of shape (number of spectra, grid size).
+    """
+    if unit not in ("eV", "nm"):
+        raise ValueError(f"Unknown unit: {unit}")
+    if lineshape == "gaussian":
+        profile = _gaussian
+    elif lineshape == "lorentzian":
+        profile = _lorentzian
+    elif lineshape == "pseudo-voigt":
+        profile = functools.partial(_pseudo_voigt, eta=eta)
+    else:
+        raise ValueError(f"Unknown line shape: {lineshape}")
+
+    if grid is None:
+        grid = np.linspace(1.5, 5.5, 1000)
+        if unit == "nm":
+            grid = HC / grid
+    grid = np.asarray(grid, dtype=np.float64)
+    grid_ev = grid if unit == "eV" else HC / grid
+
+    e, f, index = _flatten(energies, strengths)
+    spectra = np.zeros((len(energies), len(grid)))
+
+    # Every spectrum is a weighted sum of line shapes. The weights form a sparse
+    # (spectra × peaks) matrix, so each block of peaks costs one matrix product.
+    for start in range(0, len(e), CHUNK_SIZE):
+        stop = start + CHUNK_SIZE
+        shapes = profile(grid_ev[np.newaxis, :] - e[start:stop, np.newaxis], sigma)
+        weights = scipy.sparse.csr_matrix(
+            (f[start:stop], (index[start:stop], np.arange(len(shapes)))),
+            shape=(len(energies), len(shapes)),
+        )
+        spectra += weights @ shapes
+
+    return grid, spectra
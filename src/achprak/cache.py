@@ -0,0 +1,339 @@
+"""Persistent, content-addressed result cache shared between kernels."""
+
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import ase
+import ase.calculators.singlepoint
+import numpy as np
+
+from .tracing import tracer
+
+CACHE_DIR = os.environ.get(
+    "ACHPRAK_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "achprak"),
+)
+MAX_BYTES = int(os.environ.get("ACHPRAK_CACHE_MAX_BYTES", str(256 * 1024**2)))
+ENABLED = os.environ.get("ACHPRAK_CACHE", "1") != "0"
+
+# Positions are rounded before hashing, so that XYZ round trips (which keep
+# ten decimals) and tiny numerical noise map onto the same key.
+DECIMALS = 5
+
+# Inputs within MATCH_RMSD (in Å, after superposition) of a stored input are
+# considered the same input. Within WARM_START_RMSD, the stored result is
+# still a good starting point.
+MATCH_RMSD = 0.05
+WARM_START_RMSD = 0.5
+
+CALC_PARAMETERS = (
+    "method",
+    "charge",
+    "multiplicity",
+    "solvation",
+    "accuracy",
+    "electronic_temperature",
+)
+
+
+def calculator_key(calc):
+    """
+    Return the settings of a calculator that determine its results.
+    """
+    if calc is None:
+        return None
+    parameters = getattr(calc, "parameters", {})
+    return {
+        "name": type(calc).__name__,
+        **{name: parameters.get(name) for name in CALC_PARAMETERS},
+    }
+
+
+def make_key(kind, atoms, calc=None, decimals=DECIMALS, **extra):
+    """
+    Hash a structure and the settings used to compute a result into a key.
+
+    Parameters
+    ----------
+    kind
+        Type of result, e.g. ``"energy"`` or ``"opt_min"``.
+    atoms
+        ASE Atoms object.
+    calc
+        Calculator whose settings become part of the key.
+    decimals
+        Number of decimals (in Å) the positions are rounded to.
+    extra
+        Additional JSON-serializable settings (convergence criteria, etc.).
+    """
+    numbers = np.ascontiguousarray(atoms.get_atomic_numbers(), dtype=np.int64)
+    # Adding 0.0 turns -0.0 into 0.0 after rounding.
+    positions = np.round(atoms.get_positions(), decimals=decimals) + 0.0
+    positions = np.ascontiguousarray(positions, dtype=np.float64)
+
+    h = hashlib.sha256()
+    h.update(_settings(kind, calc, **extra).encode())
+    h.update(numbers.tobytes())
+    h.update(positions.tobytes())
+    return h.hexdigest()
+
+
+def _settings(kind, calc=None, **extra):
+    return json.dumps(
+        {"kind": kind, "calc": calculator_key(calc), **extra},
+        sort_keys=True,
+        default=str,
+    )
+
+
+def distance_descriptor(positions):
+    """
+    Return the sorted interatomic distances, which do not change under
+    rotations and translations.
+
+    For two structures with the same atoms, the mean absolute difference of
+    their descriptors is at most twice their RMSD after superposition.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    i, j = np.triu_indices(len(positions), k=1)
+    return np.sort(np.linalg.norm(positions[i] - positions[j], axis=1))
+
+
+def traj_to_arrays(traj):
+    """
+    Pack a list of Atoms objects (with single-point results) into arrays.
+    """
+    arrays = {
+        "traj_numbers": traj[0].get_atomic_numbers(),
+        "traj_positions": np.array([atoms.get_positions() for atoms in traj]),
+    }
+    if all(atoms.calc is not None for atoms in traj):
+        arrays["traj_energies"] = np.array(
+            [atoms.get_potential_energy() for atoms in traj]
+        )
+        arrays["traj_forces"] = np.array([atoms.get_forces() for atoms in traj])
+    return arrays
+
+
+def arrays_to_traj(arrays):
+    """
+    Unpack arrays written by traj_to_arrays into a list of Atoms objects.
+    """
+    traj = []
+    for i, positions in enumerate(arrays["traj_positions"]):
+        atoms = ase.Atoms(numbers=arrays["traj_numbers"], positions=positions)
+        if "traj_energies" in arrays:
+            atoms.calc = ase.calculators.singlepoint.SinglePointCalculator(
+                atoms,
+                energy=float(arrays["traj_energies"][i]),
+                forces=arrays["traj_forces"][i],
+            )
+        traj.append(atoms)
+    return traj
+
+
+def _dumps(arrays):
+    with io.BytesIO() as f:
+        np.savez(f, **arrays)
+        return f.getvalue()
+
+
+def _loads(data):
+    with np.load(io.BytesIO(data)) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+class ResultCache:
+    """
+    On-disk key/value store for numpy results with LRU eviction.
+
+    Entries are stored in an SQLite database in WAL mode, so that several
+    kernels on the same node can read and write concurrently. Once the total
+    size exceeds ``max_bytes``, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path=None, max_bytes=MAX_BYTES, enabled=ENABLED):
+        self.path = path or os.path.join(CACHE_DIR, "results.sqlite")
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._local = threading.local()
+
+    def _connect(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            con = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, data BLOB NOT NULL, "
+                "size INTEGER NOT NULL, atime REAL NOT NULL)"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries(atime)")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS structures ("
+                "key TEXT PRIMARY KEY, settings TEXT NOT NULL, "
+                "numbers BLOB NOT NULL, positions BLOB NOT NULL, "
+                "descriptor BLOB NOT NULL)"
+            )
+            con.execute(
+                "CREATE INDEX IF NOT EXISTS structures_settings "
+                "ON structures(settings, numbers)"
+            )
+            self._local.con = con
+        return con
+
+    def get(self, key):
+        """
+        Return the arrays stored under a key, or None.
+        """
+        if not self.enabled:
+            return None
+        try:
+            con = self._connect()
+            row = con.execute(
+                "SELECT data FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                tracer.count("cache.miss")
+                return None
+            tracer.count("cache.hit")
+            con.execute(
+                "UPDATE entries SET atime = ? WHERE key = ?", (time.time(), key)
+            )
+            return _loads(row[0])
+        except sqlite3.Error:
+            return None
+
+    def put(self, key, **arrays):
+        """
+        Store arrays under a key and evict old entries if necessary.
+        """
+        if not self.enabled:
+            return
+        data = _dumps(arrays)
+        try:
+            con = self._connect()
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                con.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                    (key, data, len(data), time.time()),
+                )
+                self._evict(con)
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            pass
+
+    def _evict(self, con):
+        (total,) = con.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        for key, size in con.execute(
+            "SELECT key, size FROM entries ORDER BY atime ASC"
+        ).fetchall():
+            if excess <= 0:
+                break
+            con.execute("DELETE FROM entries WHERE key = ?", (key,))
+            con.execute("DELETE FROM structures WHERE key = ?", (key,))
+            excess -= size
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        try:
+            con = self._connect()
+            con.execute("DELETE FROM entries")
+            con.execute("DELETE FROM structures")
+        except sqlite3.Error:
+            pass
+
+    def index(self, key, kind, atoms, calc=None, **extra):
+        """
+        Make the entry under key findable by structure (see nearest).
+
+        The arguments (except key) are the ones the key was made from.
+        """
+        if not self.enabled:
+            return
+        numbers = np.ascontiguousarray(atoms.get_atomic_numbers(), dtype=np.int64)
+        positions = np.ascontiguousarray(atoms.get_positions(), dtype=np.float64)
+        descriptor = distance_descriptor(positions).astype(np.float32)
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO structures VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    _settings(kind, calc, **extra),
+                    numbers.tobytes(),
+                    positions.tobytes(),
+                    descriptor.tobytes(),
+                ),
+            )
+        except sqlite3.Error:
+            pass
+
+    def nearest(self, kind, atoms, calc=None, max_rmsd=WARM_START_RMSD, **extra):
+        """
+        Find the indexed entry whose structure is closest to atoms.
+
+        Candidates with the same settings and atoms (in the same order) are
+        first filtered by their distance descriptors, and then superimposed
+        onto atoms.
+
+        Returns
+        -------
+        tuple or None
+            Key, RMSD, and the rotation r and translation t that superimpose
+            the stored structure onto atoms (positions @ r.T + t), if the
+            RMSD is at most max_rmsd.
+        """
+        # Imported here, since common pulls in the calculator and widget stack.
+        from .common import kabsch
+
+        if not self.enabled:
+            return None
+        numbers = np.ascontiguousarray(atoms.get_atomic_numbers(), dtype=np.int64)
+        positions = atoms.get_positions()
+        descriptor = distance_descriptor(positions)
+        try:
+            rows = (
+                self._connect()
+                .execute(
+                    "SELECT s.key, s.positions, s.descriptor FROM structures s "
+                    "JOIN entries e ON e.key = s.key "
+                    "WHERE s.settings = ? AND s.numbers = ?",
+                    (_settings(kind, calc, **extra), numbers.tobytes()),
+                )
+                .fetchall()
+            )
+        except sqlite3.Error:
+            return None
+
+        best = None
+        for key, stored, stored_descriptor in rows:
+            stored_descriptor = np.frombuffer(stored_descriptor, dtype=np.float32)
+            # Lower bound of twice the RMSD, without superposition.
+            if np.mean(np.abs(stored_descriptor - descriptor)) > 2.0 * max_rmsd:
+                continue
+            stored = np.frombuffer(stored, dtype=np.float64).reshape(-1, 3)
+            r, t, rmsd = kabsch(stored, positions)
+            if rmsd <= max_rmsd and (best is None or rmsd < best[1]):
+                best = (key, rmsd, r, t)
+        tracer.count("cache.nearest_hit" if best else "cache.nearest_miss")
+        return best
+
+
+# Instantiate a single global cache object
+result_cache = ResultCache()
@@ -1,12 +1,62 @@
+import io
+
+import ase.io
+
+
+class Artifact:
+    """
+    A clipboard entry holding a structure by reference.
+
+    XYZ text is only generated (or parsed) on demand, e.g. for display.
+    """
+
+    def __init__(self, atoms=None, mol=None, source=None, xyz=None):
+        """
+        Parameters
+        ----------
+        atoms
+            ASE Atoms object.
+        mol
+            RDKit molecule with bond orders, in the same atom order as atoms.
+        source
+            Name of the tool that produced the entry.
+        xyz
+            XYZ text, as an alternative to atoms.
+        """
+        if atoms is None and xyz is None:
+            raise ValueError("Either atoms or xyz must be given.")
+        self.mol = mol
+        self.source = source
+        self._atoms = atoms
+        self._xyz = xyz
+
+    @property
+    def atoms(self):
+        if self._atoms is None:
+            self._atoms = ase.io.read(io.StringIO(self._xyz), format="xyz")
+        return self._atoms
+
+    @property
+    def xyz(self):
+        if self._xyz is None:
+            with io.StringIO() as f:
+                ase.io.write(f, self._atoms, format="xyz")
+                self._xyz = f.getvalue()
+        return self._xyz
+
+
 class Clipboard:
     def __init__(self):
-        self._content = ""  # internal storage for clipboard content
+        self._content = None  # the most recent artifact
 
-    def copy(self, text: str) -> None:
-        """Copy text into the clipboard."""
-        self._content = text
+    def copy(self, item) -> Artifact:
+        """Copy an artifact (or XYZ text) into the clipboard."""
+        if isinstance(item, str):
+            item = Artifact(xyz=item)
+        self._content = item
+        return item
 
-    def paste(self) -> str:
+    def paste(self) -> Artifact | None:
         """Return the current clipboard content."""
         return self._content
 
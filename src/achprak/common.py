@@ -1,22 +1,29 @@
+import concurrent.futures
 import contextlib
 import io
+import multiprocessing
 import os
+import subprocess
 import sys
 import tempfile
+import threading
 
+import ase.calculators.calculator
 import ase.io
 import numpy as np
-import rdkit.Chem.rdDetermineBonds
-import rdkit.Chem.rdmolfiles
 import tblite.ase
 
-from . import ui
+from . import THREAD_VARIABLES, threads, topology, ui
 from .clipboard import clipboard
+from .tracing import tracer
 
 LABEL_STYLE = {"font_size": "15px", "font_weight": "bold"}
 OUTPUT_LAYOUT = {"height": "600px", "overflow": "auto"}
 TEXTAREA_LAYOUT = {"width": "auto", "height": "250px"}
 
+# Matplotlib style of all plots, applied per plot rather than globally.
+PLOT_STYLE = "ggplot"
+
 COPY_TEXT = "Kopieren 📋"
 COPY_OK_TEXT = "Kopiert ✅"
 COPY_ERROR_TEXT = "Fehler ❌"
@@ -29,10 +36,29 @@ RUN_START_TEXT = "Starten  ▶️"
 RUN_RUNNING_TEXT = "Läuft  ⏳️"
 RUN_OK_TEXT = "Fertig ✅"
 RUN_ERROR_TEXT = "Fehler ❌"
+RUN_CANCEL_TEXT = "Abbrechen  ⏹️"
+RUN_CANCELLING_TEXT = "Wird abgebrochen  ⏳️"
+RUN_QUEUED_TEXT = "Warteschlange: Platz {position}  ⏳️"
 
 SOLVENT_NAME = "ethanol"
 SOLVENT_EPS = 24.3
 
+# Failures of a calculation on a particular structure (embedding, bond
+# perception, SCC, optimizer or MOPAC). Anything else is a bug and propagates.
+CALCULATION_ERRORS = (
+    ArithmeticError,
+    IndexError,
+    OSError,
+    RuntimeError,
+    StopIteration,
+    ValueError,
+    subprocess.SubprocessError,
+)
+
+# Beyond this displacement (in Å) from the previous structure, the previous
+# wavefunction is no longer a useful SCC starting guess.
+WARM_START_MAX_DISPLACEMENT = 0.5
+
 
 class DefaultASECalculator(tblite.ase.TBLite):
     def __init__(
@@ -45,6 +71,78 @@ class DefaultASECalculator(tblite.ase.TBLite):
         super().__init__(
             method=method, solvation=solvation, accuracy=accuracy, verbosity=verbosity
         )
+        # Calculators may be shared between tools running in different threads.
+        self._lock = threading.RLock()
+        self._last_positions = None
+        self.warm_start_max_displacement = WARM_START_MAX_DISPLACEMENT
+
+    def get_property(self, name, atoms=None, allow_calculation=True):
+        with self._lock:
+            return super().get_property(name, atoms, allow_calculation)
+
+    def get_results(self, atoms, properties=("energy", "forces"), compute=True):
+        """
+        Return properties of atoms (a dict), all from the same calculation.
+
+        The lock is held throughout, so that no other thread sharing the
+        calculator can run a calculation in between. With compute=False, only
+        properties already computed for atoms are returned.
+        """
+        with self._lock:
+            if not compute and (self.atoms is None or self.check_state(atoms)):
+                return {}
+            results = {}
+            for name in properties:
+                value = self.get_property(name, atoms, allow_calculation=compute)
+                if value is not None:
+                    results[name] = value
+            return results
+
+    def calculate(
+        self,
+        atoms=None,
+        properties=None,
+        system_changes=ase.calculators.calculator.all_changes,
+    ):
+        # TBLite restarts the SCC from the last converged wavefunction as long as
+        # the atoms do not change. Drop it if the new structure is unrelated.
+        last = self._last_positions
+        if (
+            atoms is not None
+            and last is not None
+            and last.shape == atoms.positions.shape
+            and np.max(np.abs(atoms.positions - last))
+            > self.warm_start_max_displacement
+        ):
+            self._res = None
+            tracer.count("calculate.cold_start")
+        with tracer.span("calculate"):
+            super().calculate(atoms, properties, system_changes)
+        self._last_positions = self.atoms.positions.copy()
+
+
+_calculator_pool = {}
+_calculator_pool_lock = threading.Lock()
+
+
+def pooled_calculator(
+    method="GFN1-xTB", solvation=("alpb", SOLVENT_NAME), accuracy=1.0
+):
+    """
+    Return a shared DefaultASECalculator for the given settings.
+
+    Reusing calculators saves the setup cost and lets consecutive calculations
+    on related structures start from the last converged wavefunction.
+    """
+    key = (method, solvation, accuracy)
+    with _calculator_pool_lock:
+        calc = _calculator_pool.get(key)
+        if calc is None:
+            calc = DefaultASECalculator(
+                method=method, solvation=solvation, accuracy=accuracy
+            )
+            _calculator_pool[key] = calc
+    return calc
 
 
 def atoms_to_xyz(atoms):
@@ -83,14 +181,31 @@ def atoms_to_mol(atoms, charge=0):
     """
     Construct an RDKit Mol object from an ASE Atoms object.
     """
-    with io.StringIO() as f:
-        ase.io.write(f, atoms, format="xyz")
-        f.seek(0)
-        xyz = f.read()
+    return topology.atoms_to_mol(atoms, charge=charge)
+
 
-    mol = rdkit.Chem.rdmolfiles.MolFromXYZBlock(xyz)
-    rdkit.Chem.rdDetermineBonds.DetermineBonds(mol, charge=charge)
-    return mol
+def kabsch(p, q):
+    """
+    Superimpose positions p onto positions q (same atom order).
+
+    Returns
+    -------
+    tuple
+        Rotation matrix r, translation t (q ≈ p @ r.T + t) and the RMSD after
+        superposition.
+    """
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    p_center = p.mean(axis=0)
+    q_center = q.mean(axis=0)
+    h = (p - p_center).T @ (q - q_center)
+    u, _, vt = np.linalg.svd(h)
+    # Avoid reflections.
+    d = np.sign(np.linalg.det(vt.T @ u.T))
+    r = vt.T @ np.diag([1.0, 1.0, d]) @ u.T
+    t = q_center - p_center @ r.T
+    rmsd = np.sqrt(np.mean(np.sum((p @ r.T + t - q) ** 2, axis=1)))
+    return r, t, rmsd
 
 
 def gaussian(x, mu, sigma):
@@ -98,11 +213,15 @@ def gaussian(x, mu, sigma):
 
 
 def clipboard_to_atoms(button, output):
-    xyz = clipboard.paste()
+    artifact = clipboard.paste()
     try:
-        atoms = xyz_to_atoms(xyz)
+        # Optimizers modify atoms in place, so hand out a (cheap) copy and keep
+        # the artifact intact. Everything else is shared by reference.
+        atoms = artifact.atoms.copy()
+        if artifact.mol is not None:
+            topology.register(artifact.mol)
         with output:
-            print(xyz)
+            print(artifact.xyz)
         ui.flash_button(button, message=PASTE_OK_TEXT)
         return atoms
     except Exception:
@@ -133,3 +252,61 @@ def tempdir():
             yield tmp
         finally:
             os.chdir(cwd)
+
+
+def _init_worker():
+    # Workers inherit the environment of the kernel, but make sure every
+    # process runs single-threaded, even if the kernel was configured otherwise.
+    for var in THREAD_VARIABLES:
+        os.environ[var] = "1"
+    # Pools already use every core, so jobs must not add threads of their own.
+    os.environ["ACHPRAK_THREADS"] = "1"
+
+
+def new_process_pool(max_workers=None):
+    """
+    Create a pool of single-threaded worker processes.
+
+    Workers are spawned as fresh interpreters instead of forking the kernel,
+    which may already hold initialized OpenMP runtimes and widget state.
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers or threads.available_cpus(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    )
+
+
+_shared_pool = None
+
+
+def shared_process_pool():
+    """
+    Return a process pool shared by all tools of this kernel.
+
+    The pool is created on first use and kept alive, so that short parallel
+    tasks do not pay for spawning workers and importing tblite every time.
+    """
+    global _shared_pool
+    if _shared_pool is None:
+        _shared_pool = new_process_pool()
+    return _shared_pool
+
+
+@contextlib.contextmanager
+def process_pool(max_workers=None):
+    """
+    Yield a process pool and its number of workers.
+
+    With max_workers=None, the shared pool is used and kept alive. Otherwise,
+    a private pool is created and shut down on exit.
+    """
+    if max_workers is None:
+        pool = shared_process_pool()
+        yield pool, pool._max_workers
+    else:
+        pool = new_process_pool(max_workers)
+        try:
+            yield pool, max_workers
+        finally:
+            pool.shutdown()
@@ -0,0 +1,164 @@
+"""Conformer generation with MMFF prescreening and xTB reranking."""
+
+import contextlib
+import io
+
+import ase
+import numpy as np
+import rdkit.Chem
+import rdkit.Chem.AllChem
+
+from . import common
+
+NUM_CONFS = 30
+ENERGY_WINDOW = 10.0  # kcal/mol (MMFF)
+PRUNE_RMS = 0.5  # Å (heavy atoms)
+KEEP = 5
+
+
+def _xtb_energy(numbers, positions):
+    """
+    Worker: xTB single point energy with the pooled calculator of this process.
+    """
+    atoms = ase.Atoms(numbers=numbers, positions=positions)
+    atoms.calc = common.pooled_calculator()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return atoms.get_potential_energy()
+
+
+class ConformerSearch:
+    """
+    Tiered conformer search.
+
+    1. Embed many conformers with ETKDGv3 (multithreaded).
+    2. Optimize them with MMFF94s and drop those outside an energy window.
+    3. Prune near-duplicates by heavy-atom RMSD.
+    4. Rerank the few survivors with xTB single points in parallel.
+    """
+
+    def __init__(
+        self,
+        molh,
+        num_confs=NUM_CONFS,
+        energy_window=ENERGY_WINDOW,
+        prune_rms=PRUNE_RMS,
+        keep=KEEP,
+        num_threads=0,
+        max_workers=None,
+        seed=42,
+    ):
+        """
+        Parameters
+        ----------
+        molh
+            RDKit molecule with explicit hydrogens (not modified).
+        num_confs
+            Number of conformers to embed.
+        energy_window
+            MMFF energy window above the minimum in kcal/mol.
+        prune_rms
+            Heavy-atom RMSD threshold for duplicates in Å.
+        keep
+            Maximum number of conformers passed on to xTB.
+        num_threads
+            Threads for RDKit embedding and MMFF (0 = all cores).
+        max_workers
+            Processes for the xTB single points. With 1, they run in this
+            process; None uses the shared process pool.
+        seed
+            Random seed for the embedding.
+        """
+        self.mol = rdkit.Chem.Mol(molh)
+        self.num_confs = num_confs
+        self.energy_window = energy_window
+        self.prune_rms = prune_rms
+        self.keep = keep
+        self.num_threads = num_threads
+        self.max_workers = max_workers
+        self.seed = seed
+
+        # Filled by run(): surviving conformer ids, sorted by xTB energy.
+        self.conf_ids = []
+        self.mmff_energies = []  # kcal/mol
+        self.xtb_energies = []  # eV
+
+    def _embed(self):
+        params = rdkit.Chem.AllChem.ETKDGv3()
+        params.randomSeed = self.seed
+        params.numThreads = self.num_threads
+        self.mol.RemoveAllConformers()
+        conf_ids = list(
+            rdkit.Chem.AllChem.EmbedMultipleConfs(self.mol, self.num_confs, params)
+        )
+        if not conf_ids:
+            raise RuntimeError("RDKit 3D embedding failed for generated molecule.")
+        return conf_ids
+
+    def _prescreen(self, conf_ids):
+        results = rdkit.Chem.AllChem.MMFFOptimizeMoleculeConfs(
+            self.mol, numThreads=self.num_threads, mmffVariant="MMFF94s"
+        )
+        energies = np.array([energy for _, energy in results])
+        order = np.argsort(energies)
+        emin = energies[order[0]]
+        return [
+            (conf_ids[i], energies[i])
+            for i in order
+            if energies[i] - emin <= self.energy_window
+        ]
+
+    def _prune(self, candidates):
+        heavy = rdkit.Chem.RemoveHs(self.mol)
+        survivors = []
+        for conf_id, energy in candidates:
+            if all(
+                rdkit.Chem.AllChem.GetConformerRMS(heavy, conf_id, other)
+                > self.prune_rms
+                for other, _ in survivors
+            ):
+                survivors.append((conf_id, energy))
+                if len(survivors) == self.keep:
+                    break
+        return survivors
+
+    def _rerank(self, survivors):
+        numbers = [atom.GetAtomicNum() for atom in self.mol.GetAtoms()]
+        positions = [
+            self.mol.GetConformer(conf_id).GetPositions() for conf_id, _ in survivors
+        ]
+        if self.max_workers == 1:
+            return [_xtb_energy(numbers, pos) for pos in positions]
+
+        with common.process_pool(self.max_workers) as (pool, _):
+            futures = [pool.submit(_xtb_energy, numbers, pos) for pos in positions]
+            return [future.result() for future in futures]
+
+    def run(self):
+        """
+        Run the search and return the best conformer as ASE Atoms.
+        """
+        conf_ids = self._embed()
+        survivors = self._prune(self._prescreen(conf_ids))
+        xtb_energies = self._rerank(survivors)
+
+        order = np.argsort(xtb_energies)
+        self.conf_ids = [survivors[i][0] for i in order]
+        self.mmff_energies = [survivors[i][1] for i in order]
+        self.xtb_energies = [xtb_energies[i] for i in order]
+        return self.atoms(0)
+
+    def atoms(self, rank=0):
+        """
+        Return the conformer of the given rank (0 = lowest xTB energy).
+        """
+        conf = self.mol.GetConformer(self.conf_ids[rank])
+        return ase.Atoms(
+            positions=conf.GetPositions(),
+            numbers=[atom.GetAtomicNum() for atom in self.mol.GetAtoms()],
+        )
+
+    def ensemble(self):
+        """
+        Return all surviving conformers, sorted by xTB energy.
+        """
+        return [self.atoms(rank) for rank in range(len(self.conf_ids))]
@@ -0,0 +1,176 @@
+"""Geometric descriptors of azobenzenes, vectorized over trajectories."""
+
+import ase.data
+import numpy as np
+
+from . import topology
+
+# Columns returned by Descriptors.compute.
+NAMES = ("cnnc_dihedral", "cnn_angles", "nn_length", "ring_distance")
+
+
+def positions_array(images):
+    """
+    Stack the positions of a list of Atoms objects (e.g. OptMin.traj or
+    NEBPath.images) into an array of shape (nframes, natoms, 3).
+    """
+    return np.array([atoms.get_positions() for atoms in images], dtype=np.float64)
+
+
+def distance(positions, indices):
+    """
+    Return the distances between two atoms for all frames (in Å).
+    """
+    p0, p1 = (positions[:, i] for i in indices)
+    return np.linalg.norm(p1 - p0, axis=-1)
+
+
+def angle(positions, indices):
+    """
+    Return the angles between three atoms for all frames (in °).
+    """
+    p0, p1, p2 = (positions[:, i] for i in indices)
+    u = p0 - p1
+    v = p2 - p1
+    cos = np.sum(u * v, axis=-1) / (
+        np.linalg.norm(u, axis=-1) * np.linalg.norm(v, axis=-1)
+    )
+    return np.degrees(np.arccos(np.clip(cos, -1.0, 1.0)))
+
+
+def dihedral(positions, indices):
+    """
+    Return the dihedrals between four atoms for all frames (in °, from 0 to
+    360 like ase.Atoms.get_dihedral).
+    """
+    p0, p1, p2, p3 = (positions[:, i] for i in indices)
+    a = p1 - p0
+    b = p2 - p1
+    c = p3 - p2
+    ab = np.cross(a, b)
+    bc = np.cross(b, c)
+    x = np.sum(ab * bc, axis=-1)
+    y = np.linalg.norm(b, axis=-1) * np.sum(a * bc, axis=-1)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+class Descriptors:
+    """
+    C-N=N-C dihedral, C-N=N angles, N=N bond length and ring distance.
+
+    The atom indices are found once from the topology; afterwards, the
+    descriptors of any number of frames are computed in one pass.
+    """
+
+    def __init__(self, mol, masses=None):
+        """
+        Parameters
+        ----------
+        mol
+            RDKit Mol object with bond orders, e.g. from common.atoms_to_mol.
+        masses
+            Atomic masses for the ring centers of mass. Defaults to the
+            standard masses.
+        """
+        numbers = [atom.GetAtomicNum() for atom in mol.GetAtoms()]
+        if masses is None:
+            masses = ase.data.atomic_masses[numbers]
+        self.masses = np.asarray(masses, dtype=np.float64)
+
+        n1, n2 = self._find_azo_bond(mol)
+        c1 = self._find_carbon_neighbor(mol, n1)
+        c2 = self._find_carbon_neighbor(mol, n2)
+        if c1 is None or c2 is None:
+            raise ValueError(
+                "Could not find carbon neighbors adjacent to azo nitrogens."
+            )
+        self.cnnc = (c1, n1, n2, c2)
+        self.rings = self._find_rings(mol, c1, c2)
+
+    @classmethod
+    def from_atoms(cls, atoms):
+        """
+        Construct the descriptors for the topology of an Atoms object.
+        """
+        return cls(topology.atoms_to_mol(atoms), atoms.get_masses())
+
+    @staticmethod
+    def _find_azo_bond(mol):
+        for bond in mol.GetBonds():
+            a = bond.GetBeginAtom()
+            b = bond.GetEndAtom()
+            if (
+                a.GetSymbol() == "N"
+                and b.GetSymbol() == "N"
+                and bond.GetBondType().name == "DOUBLE"
+            ):
+                return a.GetIdx(), b.GetIdx()
+        raise ValueError("Could not find azo N=N double bond in molecule.")
+
+    @staticmethod
+    def _find_carbon_neighbor(mol, i):
+        for nbr in mol.GetAtomWithIdx(i).GetNeighbors():
+            if nbr.GetSymbol() == "C":
+                return nbr.GetIdx()
+        return None
+
+    @staticmethod
+    def _find_rings(mol, c1, c2):
+        rings = mol.GetRingInfo().AtomRings()
+        if len(rings) < 2:
+            raise ValueError("Expected at least two rings in azobenzene.")
+        # The rings attached to the azo group, if the carbons are ring atoms.
+        ring1 = next((ring for ring in rings if c1 in ring), rings[0])
+        ring2 = next((ring for ring in rings if c2 in ring), rings[1])
+        if ring1 == ring2:
+            ring1, ring2 = rings[0], rings[1]
+        return np.array(ring1), np.array(ring2)
+
+    def _center_of_mass(self, positions, ring):
+        masses = self.masses[ring]
+        return np.einsum("fij,i->fj", positions[:, ring], masses) / masses.sum()
+
+    def compute(self, positions):
+        """
+        Compute all descriptors.
+
+        Parameters
+        ----------
+        positions
+            Array of shape (nframes, natoms, 3) in Å (see positions_array), or
+            a single structure of shape (natoms, 3).
+
+        Returns
+        -------
+        dict
+            Arrays with one row per frame: C-N=N-C dihedral (°), both C-N=N
+            angles (°, shape (nframes, 2)), N=N bond length (pm) and distance
+            of the ring centers of mass (pm).
+        """
+        positions = np.asarray(positions, dtype=np.float64)
+        if positions.ndim == 2:
+            return {
+                name: values[0]
+                for name, values in self.compute(positions[None]).items()
+            }
+
+        c1, n1, n2, c2 = self.cnnc
+        com1 = self._center_of_mass(positions, self.rings[0])
+        com2 = self._center_of_mass(positions, self.rings[1])
+        return {
+            "cnnc_dihedral": dihedral(positions, self.cnnc),
+            "cnn_angles": np.stack(
+                [angle(positions, (c1, n1, n2)), angle(positions, (n1, n2, c2))],
+                axis=-1,
+            ),
+            "nn_length": distance(positions, (n1, n2)) * 100.0,  # pm
+            "ring_distance": np.linalg.norm(com1 - com2, axis=-1) * 100.0,  # pm
+        }
+
+
+def compute(images):
+    """
+    Compute the descriptors of a trajectory (a list of Atoms objects with the
+    same atoms), with the topology of the first frame.
+    """
+    return Descriptors.from_atoms(images[0]).compute(positions_array(images))
@@ -0,0 +1,378 @@
+"""
+Precomputed results for all single and double substitution patterns.
+
+The library file is not part of the repository; it has to be built offline
+(``python -m achprak.library``). Without it, the library is unavailable and
+every structure is calculated on demand.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+
+import numpy as np
+
+from . import common, symmetry, topology
+from .cache import WARM_START_RMSD, calculator_key
+
+LIBRARY_PATH = os.environ.get(
+    "ACHPRAK_LIBRARY",
+    os.path.join(os.path.dirname(__file__), "data", "substituents.npz"),
+)
+ENABLED = os.environ.get("ACHPRAK_LIBRARY_ENABLED", "1") != "0"
+
+CONFIGURATIONS = ("trans", "cis")
+MAX_SUBSTITUENTS = 2
+
+# Input structures within this RMSD (in Å) of a stored optimized structure are
+# considered identical (stored positions are float32).
+RMSD_TOLERANCE = 1e-3
+
+LIBRARY_HIT_TEXT = "Ergebnis aus der Substituentenbibliothek geladen."
+
+
+def pattern_key(configuration, substituents):
+    """
+    Return the library key of a substitution pattern. Symmetry-equivalent
+    patterns have the same key.
+
+    Parameters
+    ----------
+    configuration
+        Either "trans" or "cis".
+    substituents
+        Substituent names for r1c1, ..., r2c5.
+    """
+    configuration, substituents = symmetry.canonical(configuration, substituents)
+    return f"{configuration}:{','.join(substituents)}"
+
+
+def patterns(
+    max_substituents=MAX_SUBSTITUENTS, configurations=CONFIGURATIONS, unique=False
+):
+    """
+    Enumerate Template keyword arguments of all patterns with up to
+    max_substituents substituents (other than H).
+
+    With unique=True, only the canonical representative of every set of
+    symmetry-equivalent patterns (see symmetry.canonical) is returned.
+    """
+    from .azobenzene import Template
+
+    names = [name for name in Template.substituent_smiles if name != "H"]
+    seen = set()
+    for configuration in configurations:
+        for n in range(max_substituents + 1):
+            for slots in itertools.combinations(symmetry.SLOTS, n):
+                for subs in itertools.product(names, repeat=n):
+                    pattern = {"configuration": configuration, **dict(zip(slots, subs))}
+                    if unique:
+                        key = symmetry.canonical_pattern(pattern)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        pattern = {
+                            "configuration": key[0],
+                            **{
+                                slot: sub
+                                for slot, sub in zip(symmetry.SLOTS, key[1])
+                                if sub != "H"
+                            },
+                        }
+                    yield pattern
+
+
+def _json(obj):
+    # Round trip through JSON, so that e.g. tuples compare equal to lists.
+    return json.loads(json.dumps(obj, default=str))
+
+
+def _fingerprint(numbers, positions):
+    return topology.fingerprint(numbers, topology.connectivity(numbers, positions))
+
+
+def _aliases(result):
+    """
+    Return the fingerprints and atom permutations of the templates of all
+    patterns equivalent to a result, other than its own (canonical) pattern.
+    """
+    from .azobenzene import template_permutation
+
+    configuration, canonical = symmetry.canonical_pattern(result["pattern"])
+    equivalents = {tuple(canonical[i] for i in op) for op in symmetry.OPERATIONS}
+    aliases = []
+    for substituents in sorted(equivalents - {canonical}):
+        perm = template_permutation(configuration, canonical, substituents)
+        fingerprint = _fingerprint(result["numbers"][perm], result["positions"][perm])
+        aliases.append((fingerprint, perm))
+    return aliases
+
+
+class Library:
+    """
+    Read-only index of precomputed results (optimized structures, energies,
+    CNNC dihedrals, ring distances and INDO/CIS stick spectra).
+
+    Entries are found by pattern key, or by structure: candidates with the
+    same topology (atom order and bonds) are superimposed onto the input.
+    Entries are stored in the atom order of the canonical pattern, and found
+    in the atom order of any equivalent pattern. The file is loaded on first
+    use; without a file, the library is unavailable (and empty), and no lookup
+    serves anything.
+    """
+
+    def __init__(self, path=None, enabled=ENABLED):
+        self.path = path or LIBRARY_PATH
+        self.enabled = enabled
+        self._data = None
+        self._index = None
+        self._by_fingerprint = None
+
+    @property
+    def available(self):
+        """
+        Whether the library is enabled and its file exists.
+        """
+        return self.enabled and os.path.exists(self.path)
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+        data = {}
+        if self.available:
+            with np.load(self.path) as f:
+                data = {name: f[name] for name in f.files}
+        self._data = data
+        keys = data.get("keys", [])
+        self._index = {str(key): i for i, key in enumerate(keys)}
+        # Fingerprint -> (entry, atom permutation or None)
+        self._by_fingerprint = {}
+        for i, fp in enumerate(data.get("fingerprints", [])):
+            self._by_fingerprint.setdefault(str(fp), []).append((i, None))
+        for n, (fp, i) in enumerate(
+            zip(data.get("alias_fingerprints", []), data.get("alias_entries", []))
+        ):
+            a, b = data["alias_offsets"][n : n + 2]
+            perm = data["alias_permutations"][a:b].astype(np.int64)
+            self._by_fingerprint.setdefault(str(fp), []).append((int(i), perm))
+        return data
+
+    def __len__(self):
+        self._load()
+        return len(self._index)
+
+    def __contains__(self, key):
+        self._load()
+        return key in self._index
+
+    @property
+    def metadata(self):
+        """
+        Settings the library was computed with (calculator, keywords, fmax).
+        """
+        data = self._load()
+        return json.loads(str(data["metadata"])) if "metadata" in data else {}
+
+    def compatible(self, calc=None, keywords=None, fmax=None):
+        """
+        Whether results for a calculator (and MOPAC keywords and optimizer
+        convergence criterion) can be served.
+        """
+        if not self.available:
+            return False
+        metadata = self.metadata
+        if not metadata:
+            return False
+        if calc is not None and _json(calculator_key(calc)) != metadata["calc"]:
+            return False
+        if keywords is not None and keywords != metadata["keywords"]:
+            return False
+        return fmax is None or fmax == metadata["fmax"]
+
+    def _entry(self, i, perm=None):
+        data = self._data
+        a, b = data["atom_offsets"][i : i + 2]
+        c, d = data["excitation_offsets"][i : i + 2]
+        entry = {
+            "key": str(data["keys"][i]),
+            "numbers": data["numbers"][a:b].astype(np.int64),
+            "initial_positions": data["initial_positions"][a:b].astype(np.float64),
+            "positions": data["positions"][a:b].astype(np.float64),
+            "converged": bool(data["converged"][i]),
+            "energy": float(data["energy"][i]),
+            "cnnc_dihedral": float(data["cnnc_dihedral"][i]),
+            "ring_distance": float(data["ring_distance"][i]),
+            "excitations": data["excitations"][c:d].astype(np.float64),
+            "oscillator_strengths": data["oscillator_strengths"][c:d].astype(
+                np.float64
+            ),
+        }
+        if perm is not None:
+            for name in ("numbers", "initial_positions", "positions"):
+                entry[name] = entry[name][perm]
+        return entry
+
+    def get(self, key):
+        """
+        Return the entry (a dict) stored under a pattern key, or None. Its
+        atoms are in the order of the canonical pattern.
+        """
+        if not self.available:
+            return None
+        self._load()
+        i = self._index.get(key)
+        return None if i is None else self._entry(i)
+
+    def find(self, atoms, exact=False, max_rmsd=WARM_START_RMSD):
+        """
+        Return the entry matching a structure, or None.
+
+        The stored structures are superimposed onto the input, so that the
+        returned positions are in the frame of the input.
+
+        Parameters
+        ----------
+        atoms
+            ASE Atoms object, in the atom order of the Template of any pattern.
+        exact
+            If True, only match if the input is the optimized structure (so
+            that its energy and spectrum can be served). Otherwise, structures
+            of the same pattern (and configuration) match if they are within
+            max_rmsd of its initial or optimized structure.
+        max_rmsd
+            RMSD bound (in Å) for exact=False. Inputs further away may lie in
+            a different conformer basin.
+
+        Returns
+        -------
+        dict
+            The entry, with positions aligned onto atoms, and the RMSD of the
+            input from the optimized structure.
+        """
+        if not self.available:
+            return None
+        self._load()
+        if not self._by_fingerprint:
+            return None
+        numbers = atoms.get_atomic_numbers()
+        positions = atoms.get_positions()
+        candidates = self._by_fingerprint.get(_fingerprint(numbers, positions), [])
+
+        best = None
+        for i, perm in candidates:
+            entry = self._entry(i, perm)
+            if not np.array_equal(entry["numbers"], numbers):
+                continue
+            r, t, rmsd = common.kabsch(entry["positions"], positions)
+            # Cis and trans share their topology; tell them apart by geometry.
+            distance = rmsd
+            if not exact:
+                distance = min(
+                    rmsd, common.kabsch(entry["initial_positions"], positions)[2]
+                )
+            if best is None or distance < best[0]:
+                entry["positions"] = entry["positions"] @ r.T + t
+                entry["rmsd"] = rmsd
+                best = (distance, entry)
+
+        if best is None or best[0] > (RMSD_TOLERANCE if exact else max_rmsd):
+            return None
+        return best[1]
+
+
+# Instantiate a single global library object
+library = Library()
+
+
+def build(path=LIBRARY_PATH, max_workers=None, max_substituents=MAX_SUBSTITUENTS):
+    """
+    Compute all patterns (see patterns) and write the library.
+
+    Only one pattern of every set of symmetry-equivalent patterns is
+    computed, after checking the canonicalization against RDKit.
+
+    This takes a while and is meant to be run offline, e.g. with
+    ``python -m achprak.library``. Patterns that fail are left out.
+    """
+    from . import optimization, uvvis
+    from .screening import ScreeningRunner
+
+    symmetry.verify(patterns(max_substituents))
+
+    results = []
+    runner = ScreeningRunner(max_workers=max_workers, spectrum=True)
+    todo = list(patterns(max_substituents, unique=True))
+    for n, result in enumerate(runner.run(todo), start=1):
+        if result["error"] is None:
+            results.append(result)
+        print(f"{n}/{len(todo)}", file=sys.stderr, end="\r")
+
+    def key(result):
+        return pattern_key(*symmetry.canonical_pattern(result["pattern"]))
+
+    results.sort(key=key)
+    aliases = [(i, alias) for i, r in enumerate(results) for alias in _aliases(r)]
+    atom_counts = [len(result["numbers"]) for result in results]
+    excitation_counts = [len(result["excitations"]) for result in results]
+    metadata = {
+        "calc": _json(calculator_key(common.pooled_calculator())),
+        "keywords": uvvis.KEYWORDS,
+        "fmax": optimization.FMAX,
+    }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(
+        path,
+        metadata=np.array(json.dumps(metadata)),
+        keys=np.array([key(result) for result in results]),
+        fingerprints=np.array(
+            [_fingerprint(r["numbers"], r["positions"]) for r in results]
+        ),
+        atom_offsets=np.concatenate([[0], np.cumsum(atom_counts)]).astype(np.int64),
+        numbers=np.concatenate([r["numbers"] for r in results]).astype(np.uint8),
+        initial_positions=np.concatenate(
+            [r["initial_positions"] for r in results]
+        ).astype(np.float32),
+        positions=np.concatenate([r["positions"] for r in results]).astype(np.float32),
+        converged=np.array([r["converged"] for r in results], dtype=bool),
+        # float32 would round total energies (~1000 eV) to 1e-4 eV.
+        energy=np.array([r["energy"] for r in results], dtype=np.float64),
+        cnnc_dihedral=np.array([r["cnnc_dihedral"] for r in results], np.float32),
+        ring_distance=np.array([r["ring_distance"] for r in results], np.float32),
+        excitation_offsets=np.concatenate([[0], np.cumsum(excitation_counts)]).astype(
+            np.int64
+        ),
+        excitations=np.concatenate([r["excitations"] for r in results]).astype(
+            np.float32
+        ),
+        oscillator_strengths=np.concatenate(
+            [r["oscillator_strengths"] for r in results]
+        ).astype(np.float32),
+        alias_fingerprints=np.array([fp for _, (fp, _) in aliases]),
+        alias_entries=np.array([i for i, _ in aliases], dtype=np.int64),
+        alias_offsets=np.concatenate(
+            [[0], np.cumsum([len(perm) for _, (_, perm) in aliases])]
+        ).astype(np.int64),
+        alias_permutations=np.concatenate(
+            [perm for _, (_, perm) in aliases] or [np.zeros(0)]
+        ).astype(np.int32),
+    )
+    return len(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m achprak.library", description=build.__doc__
+    )
+    parser.add_argument("--output", default=LIBRARY_PATH)
+    parser.add_argument("--max-workers", type=int, default=None)
+    parser.add_argument("--max-substituents", type=int, default=MAX_SUBSTITUENTS)
+    args = parser.parse_args(argv)
+    n = build(args.output, args.max_workers, args.max_substituents)
+    print(f"{n} patterns written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Nudged elastic band between two minima with image forces evaluated in parallel."""
+
+import contextlib
+import io
+
+import ase
+import ase.calculators.singlepoint
+import ase.mep
+import ase.optimize
+import matplotlib.figure
+import matplotlib.pyplot as plt
+import numpy as np
+import sella
+
+from . import common, descriptors, optimization
+from .conversion import EVKJMolConverter
+
+NIMAGES = 9  # interior images
+FMAX = 0.05
+FMAX_PRE = 0.1  # before switching on the climbing image
+MAX_STEPS = 500
+
+
+def _energy_forces(numbers, positions):
+    """
+    Worker: energy and forces with the pooled calculator of this process.
+    """
+    atoms = ase.Atoms(numbers=numbers, positions=positions)
+    atoms.calc = common.pooled_calculator()
+    with contextlib.redirect_stdout(io.StringIO()):
+        return atoms.get_potential_energy(), atoms.get_forces()
+
+
+def _attach_results(atoms, energy, forces):
+    atoms.calc = ase.calculators.singlepoint.SinglePointCalculator(
+        atoms, energy=energy, forces=forces
+    )
+
+
+def _needs_calculation(atoms):
+    """
+    Whether atoms have no results attached for their current positions.
+    """
+    calc = atoms.calc
+    if not isinstance(calc, ase.calculators.singlepoint.SinglePointCalculator):
+        return True
+    return bool(calc.check_state(atoms))
+
+
+class _PoolNEB(ase.mep.NEB):
+    """
+    NEB that evaluates all interior images concurrently in a process pool.
+
+    Before every force call, the images that moved are computed in the pool
+    and their results attached as single-point calculators, which the NEB base
+    class then only reads. Images whose attached results still belong to their
+    current positions are not recomputed.
+    """
+
+    def __init__(self, images, pool, **kwargs):
+        super().__init__(images, **kwargs)
+        self.pool = pool
+
+    def get_forces(self):
+        stale = [image for image in self.images[1:-1] if _needs_calculation(image)]
+        futures = [
+            self.pool.submit(
+                _energy_forces, image.get_atomic_numbers(), image.get_positions()
+            )
+            for image in stale
+        ]
+        for image, future in zip(stale, futures):
+            _attach_results(image, *future.result())
+        return super().get_forces()
+
+
+class NEBPath:
+    """
+    Minimum energy path between two minima (e.g. cis and trans azobenzene).
+    """
+
+    def __init__(
+        self,
+        initial,
+        final,
+        nimages=NIMAGES,
+        climb=True,
+        fmax=FMAX,
+        steps=MAX_STEPS,
+        max_workers=None,
+    ):
+        """
+        Parameters
+        ----------
+        initial, final
+            Optimized end points with identical atom order, e.g. the atoms of
+            OptMin runs started from cis and trans Templates.
+        nimages
+            Number of interior images.
+        climb
+            Whether to finish with a climbing-image NEB.
+        fmax
+            Force convergence criterion in eV/Å.
+        steps
+            Maximum number of optimizer steps per stage.
+        max_workers
+            Number of processes (None uses the shared process pool).
+        """
+        if list(initial.numbers) != list(final.numbers):
+            raise ValueError("End points must have the same atoms in the same order.")
+
+        self.images = [initial.copy()]
+        self.images += [initial.copy() for _ in range(nimages)]
+        self.images += [final.copy()]
+        self.climb = climb
+        self.fmax = fmax
+        self.steps = steps
+        self.max_workers = max_workers
+
+        self.converged = False
+        self.energies = None
+        self.ts = None
+
+    def _optimize(self, neb, fmax):
+        opt = ase.optimize.FIRE(neb, logfile=None)
+        return opt.run(fmax=fmax, steps=self.steps)
+
+    def run(self, refine=False):
+        """
+        Optimize the band.
+
+        Parameters
+        ----------
+        refine
+            Whether to refine the highest image with Sella (order=1). The
+            transition state is stored in self.ts.
+
+        Returns
+        -------
+        bool
+            Whether the band converged.
+        """
+        with common.process_pool(self.max_workers) as (pool, _):
+            # End point energies are needed by the NEB, but never change.
+            for image in (self.images[0], self.images[-1]):
+                future = pool.submit(
+                    _energy_forces, image.get_atomic_numbers(), image.get_positions()
+                )
+                _attach_results(image, *future.result())
+
+            neb = _PoolNEB(self.images, pool, climb=False)
+            neb.interpolate(method="idpp")
+            if self.climb:
+                self._optimize(neb, max(self.fmax, FMAX_PRE))
+                neb = _PoolNEB(self.images, pool, climb=True)
+            self.converged = self._optimize(neb, self.fmax)
+
+        self.energies = np.array(
+            [image.get_potential_energy() for image in self.images]
+        )
+
+        if refine:
+            self.ts = self._refine()
+        return self.converged
+
+    def _refine(self):
+        highest = int(np.argmax(self.energies[1:-1])) + 1
+        ts = self.images[highest].copy()
+        ts.calc = common.pooled_calculator(accuracy=0.1)
+        opt = sella.Sella(ts, order=1, internal=True, logfile=None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            opt.run(fmax=optimization.FMAX)
+        # Report the energy at the same accuracy as the images.
+        ts.calc = common.pooled_calculator()
+        return ts
+
+    def barrier(self):
+        """
+        Return the forward barrier in kJ/mol (highest image, or refined TS).
+        """
+        if self.ts is not None:
+            top = self.ts.get_potential_energy()
+        else:
+            top = np.max(self.energies)
+        return EVKJMolConverter.ev_to_kjmol(top - self.energies[0])
+
+    def descriptors(self):
+        """
+        Return the geometric descriptors of all images (see descriptors.compute).
+        """
+        return descriptors.compute(self.images)
+
+    def plot(self, ax=None):
+        """
+        Plot the energy profile along the band.
+
+        Parameters
+        ----------
+        ax
+            Matplotlib axes to draw on. By default, a new standalone figure is
+            created.
+
+        Returns
+        -------
+        matplotlib.axes.Axes
+            The axes drawn on.
+        """
+        with plt.style.context(common.PLOT_STYLE):
+            if ax is None:
+                ax = matplotlib.figure.Figure().subplots()
+            relative = EVKJMolConverter.ev_to_kjmol(self.energies - self.energies[0])
+            ax.plot(np.arange(len(relative)), relative, marker="o", color="C0")
+            ax.set_xlabel("Bild")
+            ax.set_ylabel("Relative Energie / kJ/mol")
+        return ax
@@ -1,19 +1,120 @@
 import contextlib
-import io
-import os
-import tempfile
+import functools
+import sys
+import threading
+import time
+import traceback
 
-import IPython.display
-import ase.io
+import ase.calculators.singlepoint
 import ase.optimize
-import ase.vibrations
+import IPython.display
 import ipywidgets
 import rdkit.Chem.AllChem
 import rdkit.Chem.rdMolTransforms
 import sella
 
-from . import azobenzene, common, ui
-from .clipboard import clipboard
+from . import azobenzene, common, threads, ui
+from .cache import (
+    MATCH_RMSD,
+    arrays_to_traj,
+    make_key,
+    result_cache,
+    traj_to_arrays,
+)
+from .clipboard import Artifact, clipboard
+from .library import LIBRARY_HIT_TEXT, library
+from .scheduler import JobCancelled, scheduler
+from .tracing import tracer
+from .vibrations import ParallelVibrations
+
+FMAX = 0.02
+
+# Maximum number of live trajectory updates per second.
+FRAME_RATE = 5.0
+
+CACHE_HIT_TEXT = "Ergebnis aus dem Zwischenspeicher geladen."
+SIMILAR_HIT_TEXT = (
+    "Ergebnis einer nahezu identischen Struktur aus dem Zwischenspeicher geladen."
+)
+WARM_START_TEXT = "Start von einer ähnlichen, bereits optimierten Struktur."
+
+
+class OptimizationCancelled(Exception):
+    """
+    Raised when an optimization is stopped before convergence.
+    """
+
+
+def _open_log(logfile):
+    return sys.stdout if logfile == "-" else logfile
+
+
+class TrajectoryCollector:
+    """
+    In-memory trajectory observer for ASE optimizers.
+
+    Each call records a snapshot of the atoms together with their energy and
+    forces. The growing list of frames is passed to an optional callback, at
+    most frame_rate times per second.
+    """
+
+    def __init__(self, atoms, callback=None, frame_rate=FRAME_RATE):
+        self.atoms = atoms
+        self.frames = []
+        self.callback = callback
+        self.interval = 1.0 / frame_rate
+        self._last_push = -float("inf")
+
+    def __call__(self):
+        frame = self.atoms.copy()
+        frame.calc = ase.calculators.singlepoint.SinglePointCalculator(
+            frame,
+            energy=self.atoms.get_potential_energy(),
+            forces=self.atoms.get_forces(),
+        )
+        self.frames.append(frame)
+
+        now = time.monotonic()
+        if self.callback is not None and now - self._last_push >= self.interval:
+            self._last_push = now
+            self.callback(self.frames)
+
+    def flush(self):
+        """
+        Pass all frames to the callback, regardless of the frame rate.
+        """
+        if self.callback is not None and self.frames:
+            self.callback(self.frames)
+
+
+def _superimpose(entry, r, t):
+    """
+    Return a copy of a cached optimization result, rotated by r and
+    translated by t (see ResultCache.nearest).
+    """
+    entry = dict(entry)
+    entry["positions"] = entry["positions"] @ r.T + t
+    if "traj_positions" in entry:
+        entry["traj_positions"] = entry["traj_positions"] @ r.T + t
+    if "traj_forces" in entry:
+        entry["traj_forces"] = entry["traj_forces"] @ r.T
+    return entry
+
+
+def _run_optimizer(opt, stop=None, name="step"):
+    """
+    Run an ASE optimizer step by step, checking for cancellation in between.
+    Every step is traced as a span with the given name.
+    """
+    converged = False
+    with threads.limit(threads.job_threads("tblite")):
+        start = time.perf_counter()
+        for converged in opt.irun(fmax=FMAX):
+            tracer.record(name, start)
+            if stop is not None and stop.is_set():
+                raise OptimizationCancelled()
+            start = time.perf_counter()
+    return converged
 
 
 class OptMin:
@@ -23,19 +124,81 @@ class OptMin:
 
     def __init__(self, atoms, calc=None):
         self.atoms = atoms
-        self.atoms.calc = calc or common.DefaultASECalculator()
+        self.atoms.calc = calc or common.pooled_calculator()
         self.traj = None
 
-    def run(self, output=None):
+    def run(self, output=None, logfile="-", stop=None, on_frame=None, slot=None):
         """
         Perform a geometry optimization.
+
+        Parameters
+        ----------
+        output
+            Context manager capturing the program output (e.g. an Output widget).
+        logfile
+            File-like object for the program output (defaults to stdout).
+        stop
+            Optional threading.Event. If set, the optimization is cancelled after
+            the current step and OptimizationCancelled is raised.
+        on_frame
+            Optional callback receiving the list of frames recorded so far. It is
+            called while the optimization is running, throttled to FRAME_RATE.
+        slot
+            Optional context manager that is only entered around an actual
+            calculation (not for cached results), e.g. scheduler.slot().
         """
-        with tempfile.NamedTemporaryFile(suffix=".traj") as tmp:
-            opt = sella.Sella(self.atoms, order=0, internal=True, trajectory=tmp.name)
-            output = output or contextlib.nullcontext()
+        output = output or contextlib.nullcontext()
+        slot = slot or contextlib.nullcontext()
+        log = _open_log(logfile)
+
+        initial = self.atoms.copy()
+        calc = self.atoms.calc
+        key = make_key("opt_min", initial, calc, fmax=FMAX)
+        entry = result_cache.get(key)
+        message = CACHE_HIT_TEXT
+
+        # Otherwise, look for a slightly different input (rotated, rounded,
+        # re-embedded, ...) that was optimized before.
+        warm_start = None
+        if entry is None:
+            match = result_cache.nearest("opt_min", initial, calc, fmax=FMAX)
+            similar = match and result_cache.get(match[0])
+            if similar is not None:
+                _, rmsd, r, t = match
+                similar = _superimpose(similar, r, t)
+                if rmsd <= MATCH_RMSD:
+                    entry = similar
+                    message = SIMILAR_HIT_TEXT
+                elif similar["converged"]:
+                    warm_start = similar["positions"]
+
+        if entry is not None:
+            self.atoms.positions = entry["positions"]
+            self.traj = arrays_to_traj(entry)
             with output:
-                converged = opt.run(fmax=0.02)
-            self.traj = ase.io.read(tmp.name, index=":")
+                print(message, file=log)
+            return bool(entry["converged"])
+
+        if warm_start is not None:
+            self.atoms.positions = warm_start
+            with output:
+                print(WARM_START_TEXT, file=log)
+
+        collector = TrajectoryCollector(self.atoms, callback=on_frame)
+        opt = sella.Sella(self.atoms, order=0, internal=True, logfile=logfile)
+        opt.attach(collector)
+        with slot, output:
+            converged = _run_optimizer(opt, stop, name="OptMin.step")
+        collector.flush()
+        self.traj = collector.frames
+
+        result_cache.put(
+            key,
+            converged=converged,
+            positions=self.atoms.get_positions(),
+            **traj_to_arrays(self.traj),
+        )
+        result_cache.index(key, "opt_min", initial, calc, fmax=FMAX)
         return converged
 
 
@@ -58,7 +221,8 @@ class OptTS:
         atoms
             Initial structure as ASE Atoms.
         calc
-            ASE calculator to be used by Sella (defaults to DefaultASECalculator).
+            ASE calculator to be used by Sella (defaults to a pooled
+            DefaultASECalculator).
         """
         properties = azobenzene.Properties(atoms)
         mol = properties.mol
@@ -85,18 +249,45 @@ class OptTS:
 
         # Convert back to ASE and attach calculator.
         self.atoms = common.mol_to_atoms(mol)
-        self.atoms.calc = calc or common.DefaultASECalculator(accuracy=0.1)
+        self.atoms.calc = calc or common.pooled_calculator(accuracy=0.1)
         self.traj = None
 
-    def run(self, output=None):
+    def run(self, output=None, logfile="-", stop=None, on_frame=None, slot=None):
         """
         Run Sella.
+
+        The parameters are the same as for OptMin.run.
         """
-        # Run the TS optimization.
-        opt = sella.Sella(self.atoms, order=1, internal=True)
         output = output or contextlib.nullcontext()
+        slot = slot or contextlib.nullcontext()
+        log = _open_log(logfile)
+
+        key = make_key("opt_ts", self.atoms, self.atoms.calc, fmax=FMAX)
+        entry = result_cache.get(key)
+        if entry is not None:
+            self.atoms.positions = entry["positions"]
+            with output:
+                print(CACHE_HIT_TEXT, file=log)
+            if "frequencies" in entry:
+                self.traj = arrays_to_traj(entry)
+                with output:
+                    self._print_frequencies(entry["frequencies"], log)
+            return bool(entry["converged"])
+
+        with slot:
+            return self._optimize(key, output, log, logfile, stop, on_frame)
+
+    def _optimize(self, key, output, log, logfile, stop, on_frame):
+        # Run the TS optimization.
+        opt = sella.Sella(self.atoms, order=1, internal=True, logfile=logfile)
+        collector = TrajectoryCollector(self.atoms, callback=on_frame)
+        opt.attach(collector)
         with output:
-            converged = opt.run(fmax=0.02)
+            converged = _run_optimizer(opt, stop, name="OptTS.step")
+        collector.flush()
+
+        if stop is not None and stop.is_set():
+            raise OptimizationCancelled()
 
         # Make a trajectory of the lowest-energy normal mode and print frequencies.
         if converged:
@@ -104,7 +295,7 @@ class OptTS:
             indices = properties.cnnc_dihedral_indices()
             # NOTE:
             # We restrict the vibrational analysis to the CNNC atoms only.
-            # This significantly reduces computational cost because ASE
+            # This significantly reduces computational cost because
             # finite-difference vibrations scale with the number of atoms.
             #
             # For azobenzene TS validation, this is sufficient because we
@@ -113,25 +304,40 @@ class OptTS:
             #
             # This is NOT a full vibrational analysis and should not be
             # used for thermochemistry.
-            vibrations = ase.vibrations.Vibrations(self.atoms, indices=indices)
-            with common.tempdir() as tmp:
-                # Run the finite-difference vibrational analysis quietly.
-                with contextlib.redirect_stdout(io.StringIO()):
-                    vibrations.run()
-
-                # Print frequencies to the output widget/context.
-                freqs = vibrations.get_frequencies()
-                with output:
-                    print("Vibrational frequencies (cm^-1) [CNNC subset only]:")
-                    for i, f in enumerate(freqs):
-                        print(f"  {i:3d}: {f}")
-
-                # Write a mode trajectory for visualization (mode 0 = lowest frequency).
-                vibrations.write_mode(0, nimages=60, kT=1.0)
-                fname = os.path.join(tmp, "vib.0.traj")
-                self.traj = ase.io.Trajectory(fname)
+            #
+            # The few displaced force calls run in this process: they hold one
+            # scheduler slot (a process pool would occupy every core), and
+            # they start from the converged wavefunction of the TS.
+            vibrations = ParallelVibrations(self.atoms, indices=indices, max_workers=1)
+            vibrations.run()
+
+            # Print frequencies to the output widget/context.
+            freqs = vibrations.get_frequencies()
+            with output:
+                self._print_frequencies(freqs, log)
+
+            # Mode trajectory for visualization (mode 0 = lowest frequency).
+            self.traj = vibrations.mode_traj(0, nimages=60, kT=1.0)
+
+            result_cache.put(
+                key,
+                converged=converged,
+                positions=self.atoms.get_positions(),
+                frequencies=freqs,
+                **traj_to_arrays(self.traj),
+            )
+        else:
+            result_cache.put(
+                key, converged=converged, positions=self.atoms.get_positions()
+            )
         return converged
 
+    @staticmethod
+    def _print_frequencies(freqs, log):
+        print("Vibrational frequencies (cm^-1) [CNNC subset only]:", file=log)
+        for i, f in enumerate(freqs):
+            print(f"  {i:3d}: {f}", file=log)
+
 
 class OptTool:
     """
@@ -144,6 +350,12 @@ class OptTool:
         self.opt = None
         self.traj = None
 
+        # Background worker, its cancellation flag, and a lock so that a
+        # reset does not interleave with the worker reporting its outcome.
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
         # Output widgets and friends.
         self._xyz_init_output = ipywidgets.Output()
         self._xyz_opt_output = ipywidgets.Output()
@@ -202,24 +414,39 @@ class OptTool:
             if self.atoms is not None:
                 self._run_button.disabled = False
         elif button is self._run_button:
-            self._run_button.disabled = True
-            self._run_button.description = common.RUN_RUNNING_TEXT
-            self._run()
-            if self.converged:
-                self._run_button.description = common.RUN_OK_TEXT
+            if self._thread is not None:
+                # The run button doubles as a cancel button while running.
+                self._stop.set()
+                self._run_button.disabled = True
+                self._run_button.description = common.RUN_CANCELLING_TEXT
             else:
-                self._run_button.description = common.RUN_ERROR_TEXT
-            self._update()
+                self._start()
         elif button is self._copy_button:
-            xyz = common.atoms_to_xyz(self.atoms)
-            clipboard.copy(xyz)
+            clipboard.copy(self._artifact())
             ui.flash_button(button, message=common.COPY_OK_TEXT)
 
     def _on_change(self, change):
         if change["type"] == "change" and change["name"] == "value":
             self._reset()
 
+    def _artifact(self):
+        """
+        Package the optimized structure for the clipboard.
+
+        Its energy and forces go to the result cache, so that downstream single
+        points with the same settings reuse them.
+        """
+        atoms = self.atoms.copy()
+        calc = self.atoms.calc
+        if calc is not None:
+            # Only results of this structure, without computing anything.
+            results = calc.get_results(atoms, compute=False)
+            if "energy" in results:
+                result_cache.put(make_key("energy", atoms, calc), **results)
+        return Artifact(atoms, source="OptTool")
+
     def _reset(self):
+        self._cancel()
         self._xyz_init_output.clear_output()
         self._run_output.clear_output()
         self._ngl_accordion.clear()
@@ -232,23 +459,138 @@ class OptTool:
         self._run_button.disabled = True
         self._run_button.description = common.RUN_START_TEXT
 
-    def _run(self):
+    def _start(self):
+        """
+        Start the optimization in a background thread.
+        """
+        self._stop = threading.Event()
+        self._run_button.description = common.RUN_CANCEL_TEXT
+        self._thread = threading.Thread(
+            target=self._work,
+            args=(self._stop, self.atoms, self._target_buttons.value),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _cancel(self):
+        """
+        Stop a running optimization and detach the worker.
+
+        The worker is not waited for, since parts of a run (e.g. the
+        vibrational analysis of a TS) cannot be interrupted. It finishes on its
+        own, and its result is dropped.
         """
-        Run the optimization.
+        with self._lock:
+            if self._thread is not None:
+                self._stop.set()
+                self._thread = None
+
+    def _work(self, stop, atoms, target):
+        """
+        Worker thread: run the optimization and report the outcome, unless the
+        tool was reset in the meantime.
         """
-        if self._target_buttons.value == "Minimum":
-            self.opt = OptMin(self.atoms)
+        error = message = None
+        try:
+            opt, converged, traj = self._run(stop, atoms, target)
+        except (OptimizationCancelled, JobCancelled) as e:
+            error = e
+        except common.CALCULATION_ERRORS as e:
+            error = e
+            message = traceback.format_exc()
+        except BaseException:
+            # Bugs are reported like any other exception in a thread.
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._run_button.description = common.RUN_ERROR_TEXT
+                    self._run_button.disabled = True
+                    self._thread = None
+            raise
+
+        with self._lock:
+            if self._thread is not threading.current_thread():
+                return
+            self._thread = None
+            if isinstance(error, (OptimizationCancelled, JobCancelled)):
+                self._run_output.append_stdout("Abgebrochen.\n")
+                self._run_button.description = common.RUN_START_TEXT
+                self._run_button.disabled = False
+            elif error is not None:
+                self._run_output.append_stderr(message)
+                self._run_button.description = common.RUN_ERROR_TEXT
+                self._run_button.disabled = True
+            else:
+                self.opt = opt
+                self.atoms = opt.atoms
+                self.converged = converged
+                self.traj = traj
+                if converged:
+                    self._run_button.description = common.RUN_OK_TEXT
+                else:
+                    self._run_button.description = common.RUN_ERROR_TEXT
+                self._run_button.disabled = True
+                self._update()
+
+    def _run(self, stop, atoms, target):
+        """
+        Run the optimization. Return the optimizer, whether it converged and
+        the trajectory.
+        """
+        if target == "Minimum":
+            opt = OptMin(atoms)
+            if library.compatible(opt.atoms.calc, fmax=FMAX):
+                entry = library.find(opt.atoms)
+                if entry is not None:
+                    return opt, *self._serve(opt.atoms, entry)
         else:
-            self.opt = OptTS(self.atoms)
+            opt = OptTS(atoms)
+
+        def on_frame(frames):
+            if not stop.is_set():
+                self._ngl_accordion.stream_traj(frames)
+
+        # Output widgets cannot be used as context managers from a background
+        # thread, so the program output is appended to the widget directly.
+        converged = opt.run(
+            logfile=ui.OutputStream(self._run_output, stop=stop),
+            stop=stop,
+            on_frame=on_frame,
+            slot=self._slot(stop),
+        )
+        return opt, converged, opt.traj
 
-        self.converged = self.opt.run(output=self._run_output)
-        self.atoms = self.opt.atoms
-        self.traj = self.opt.traj
+    @contextlib.contextmanager
+    def _slot(self, stop):
+        """
+        Wait for a free slot on the node (only for actual calculations). The
+        button still cancels while the job is queued.
+        """
+        on_wait = functools.partial(self._on_queue, stop)
+        with scheduler.slot("OptTool", on_wait=on_wait, stop=stop):
+            if not stop.is_set():
+                self._run_button.description = common.RUN_CANCEL_TEXT
+            yield
+
+    def _serve(self, atoms, entry):
+        """
+        Take the optimized structure from the substituent library. Return
+        whether it converged and the trajectory.
+        """
+        start = atoms.copy()
+        atoms.positions = entry["positions"]
+        self._run_output.append_stdout(LIBRARY_HIT_TEXT + "\n")
+        return entry["converged"], [start, atoms.copy()]
+
+    def _on_queue(self, stop, position):
+        if not stop.is_set():
+            self._run_button.description = common.RUN_QUEUED_TEXT.format(
+                position=position
+            )
 
     def _update(self):
         """
         Show the results of the optimization.
         """
         self._ngl_accordion.show_traj(self.traj)
-        with self._xyz_opt_output:
-            print(common.atoms_to_xyz(self.atoms))
+        # Called from the worker thread.
+        self._xyz_opt_output.append_stdout(common.atoms_to_xyz(self.atoms) + "\n")
@@ -0,0 +1,202 @@
+"""Relaxed scan of the C-N=N-C dihedral."""
+
+import contextlib
+import io
+
+import ase
+import ase.constraints
+import ase.optimize
+import matplotlib.figure
+import matplotlib.pyplot as plt
+import numpy as np
+
+from . import azobenzene, common
+from .conversion import EVKJMolConverter
+
+FMAX = 0.05
+MAX_STEPS = 500
+ANGLES = np.linspace(0.0, 180.0, 19)  # °
+
+
+def _moving_side(mol, n1, n2):
+    """
+    Return a mask of the atoms on the n2 side of the N=N bond.
+    """
+    mask = np.zeros(mol.GetNumAtoms(), dtype=bool)
+    stack = [n2]
+    while stack:
+        i = stack.pop()
+        if mask[i]:
+            continue
+        mask[i] = True
+        for nbr in mol.GetAtomWithIdx(i).GetNeighbors():
+            j = nbr.GetIdx()
+            if j != n1 and not mask[j]:
+                stack.append(j)
+    return mask
+
+
+def _scan_segment(numbers, positions, indices, mask, angles, fmax, steps):
+    """
+    Worker: relaxed scan over consecutive angles.
+
+    Each point starts from the optimized geometry of the previous one, and the
+    calculator keeps the previous wavefunction as SCC starting guess. Returns
+    the energies, geometries and whether each optimization converged.
+    """
+    atoms = ase.Atoms(numbers=numbers, positions=positions)
+    calc = common.DefaultASECalculator()
+    calc.warm_start_max_displacement = np.inf
+    atoms.calc = calc
+
+    energies = []
+    geometries = []
+    converged = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for angle in angles:
+            atoms.set_constraint()
+            atoms.set_dihedral(*indices, angle, mask=mask)
+            atoms.set_constraint(
+                ase.constraints.FixInternals(dihedrals_deg=[[angle, list(indices)]])
+            )
+            opt = ase.optimize.BFGS(atoms, logfile=None)
+            converged.append(opt.run(fmax=fmax, steps=steps))
+            energies.append(atoms.get_potential_energy())
+            geometries.append(atoms.get_positions())
+    return np.array(energies), np.array(geometries), np.array(converged, dtype=bool)
+
+
+class DihedralScan:
+    """
+    Relaxed scan of the C-N=N-C dihedral with xTB.
+
+    The scan is split into contiguous segments that run in parallel. Within a
+    segment, every point is warm-started from its neighbor.
+    """
+
+    def __init__(
+        self,
+        atoms,
+        angles=ANGLES,
+        segments=None,
+        fmax=FMAX,
+        steps=MAX_STEPS,
+        max_workers=None,
+    ):
+        """
+        Parameters
+        ----------
+        atoms
+            Starting structure (not modified), e.g. Template.atoms or an
+            optimized minimum.
+        angles
+            Dihedral angles in degrees, in scan order (default: ANGLES).
+        segments
+            Number of segments (defaults to the number of workers, but at least
+            three points per segment).
+        fmax
+            Force convergence criterion in eV/Å.
+        steps
+            Maximum number of optimization steps per point.
+        max_workers
+            Number of processes (None uses the shared process pool).
+        """
+        self.atoms = atoms.copy()
+        self.angles = np.array(angles, dtype=np.float64)
+        self.fmax = fmax
+        self.steps = steps
+        self.max_workers = max_workers
+        self.segments = segments
+
+        properties = azobenzene.Properties(self.atoms)
+        self.indices = properties.cnnc_dihedral_indices()
+        _, n1, n2, _ = self.indices
+        self.mask = _moving_side(properties.mol, n1, n2)
+
+        self.energies = None
+        self.geometries = None
+        self.converged = None
+
+    def run(self):
+        """
+        Run the scan and return the angles and energies (in eV).
+
+        Whether the optimization of each point converged is stored in
+        self.converged. Points that did not converge within steps are kept,
+        but their energies are unreliable.
+        """
+        with common.process_pool(self.max_workers) as (pool, nworkers):
+            segments = self.segments or max(1, min(nworkers, len(self.angles) // 3))
+            futures = [
+                pool.submit(
+                    _scan_segment,
+                    self.atoms.get_atomic_numbers(),
+                    self.atoms.get_positions(),
+                    self.indices,
+                    self.mask,
+                    angles,
+                    self.fmax,
+                    self.steps,
+                )
+                for angles in np.array_split(self.angles, segments)
+                if len(angles) > 0
+            ]
+            results = [future.result() for future in futures]
+
+        self.energies = np.concatenate([energies for energies, _, _ in results])
+        self.converged = np.concatenate([converged for _, _, converged in results])
+        numbers = self.atoms.get_atomic_numbers()
+        self.geometries = [
+            ase.Atoms(numbers=numbers, positions=positions)
+            for _, geometries, _ in results
+            for positions in geometries
+        ]
+        return self.angles, self.energies
+
+    def profile(self):
+        """
+        Return the angles and energies relative to the minimum in kJ/mol.
+
+        The minimum is taken over the converged points (if there are any).
+        """
+        converged = self.energies[self.converged]
+        reference = np.min(converged) if len(converged) else np.min(self.energies)
+        relative = self.energies - reference
+        return self.angles, EVKJMolConverter.ev_to_kjmol(relative)
+
+    def plot(self, ax=None):
+        """
+        Plot the energy profile. Points that did not converge are marked with
+        crosses and left out of the line.
+
+        Parameters
+        ----------
+        ax
+            Matplotlib axes to draw on. By default, a new standalone figure is
+            created.
+
+        Returns
+        -------
+        matplotlib.axes.Axes
+            The axes drawn on.
+        """
+        with plt.style.context(common.PLOT_STYLE):
+            if ax is None:
+                ax = matplotlib.figure.Figure().subplots()
+            angles, energies = self.profile()
+            ok = self.converged
+            ax.plot(angles[ok], energies[ok], marker="o", color="C0")
+            if not ok.all():
+                ax.plot(
+                    angles[~ok],
+                    energies[~ok],
+                    linestyle="",
+                    marker="x",
+                    color="C1",
+                    label="Nicht konvergiert",
+                )
+                ax.legend()
+            ax.set_xlim(self.angles.min(), self.angles.max())
+            ax.set_xlabel("Diederwinkel (C-N=N-C) / °")
+            ax.set_ylabel("Relative Energie / kJ/mol")
+        return ax
@@ -0,0 +1,246 @@
+"""Node-wide admission control for heavy calculations, shared between kernels."""
+
+import collections
+import contextlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .tracing import tracer
+
+# The queue must be visible to all kernels on the node, so it lives in the
+# (node-local) temporary directory rather than in the per-user cache.
+SCHEDULER_PATH = os.environ.get(
+    "ACHPRAK_SCHEDULER_PATH",
+    os.path.join(tempfile.gettempdir(), "achprak-scheduler.sqlite"),
+)
+# Each job runs single-threaded, so by default one job per core.
+MAX_JOBS = int(os.environ.get("ACHPRAK_MAX_JOBS", os.cpu_count() or 1))
+ENABLED = os.environ.get("ACHPRAK_SCHEDULER", "1") != "0"
+
+POLL_INTERVAL = 0.5  # s
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """
+    Raised when a job is cancelled while waiting in the queue.
+    """
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user.
+        return True
+    return True
+
+
+class Scheduler:
+    """
+    Caps the number of heavy jobs running at the same time on this node.
+
+    Jobs of all kernels wait in a queue stored in an SQLite database. Waiting
+    jobs are admitted round-robin over kernels (and first come, first served
+    within a kernel), so that a single kernel cannot starve the others. Jobs of
+    kernels that died are removed from the queue. If the queue cannot be
+    accessed, jobs run right away, and an error is logged.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        max_jobs=MAX_JOBS,
+        enabled=ENABLED,
+        poll_interval=POLL_INTERVAL,
+    ):
+        self.path = path or SCHEDULER_PATH
+        self.max_jobs = max_jobs
+        self.enabled = enabled
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+
+    def _share(self):
+        """
+        Make the database writable for the kernels of all users.
+
+        SQLite creates the WAL and shared memory files with the permissions of
+        the database, so this must happen before the first connection.
+        """
+        # Errors surface (and are logged) when connecting.
+        with contextlib.suppress(OSError):
+            os.close(os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        for path in (self.path, self.path + "-wal", self.path + "-shm"):
+            # Only the owner may change the permissions.
+            with contextlib.suppress(OSError):
+                if os.stat(path).st_uid == os.getuid():
+                    os.chmod(path, 0o666)
+
+    def _connect(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            self._share()
+            con = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS tickets ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, pid INTEGER NOT NULL, "
+                "name TEXT, state TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._local.con = con
+        return con
+
+    def _enqueue(self, name):
+        try:
+            cur = self._connect().execute(
+                "INSERT INTO tickets (pid, name, state, created) "
+                "VALUES (?, ?, 'waiting', ?)",
+                (os.getpid(), name, time.time()),
+            )
+            return cur.lastrowid
+        except sqlite3.Error:
+            logger.exception(
+                "Cannot access the job queue %s; %s runs without admission control.",
+                self.path,
+                name,
+            )
+            return None
+
+    def _poll(self, ticket):
+        """
+        Admit the ticket if possible. Return 0 if admitted, and otherwise its
+        position in the queue (starting at 1).
+        """
+        try:
+            con = self._connect()
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                position = self._admit(con, ticket)
+                con.execute("COMMIT")
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            return position
+        except sqlite3.Error:
+            logger.exception(
+                "Cannot access the job queue %s; job %d runs without waiting.",
+                self.path,
+                ticket,
+            )
+            return 0
+
+    def _admit(self, con, ticket):
+        pids = [pid for (pid,) in con.execute("SELECT DISTINCT pid FROM tickets")]
+        for pid in pids:
+            if not _alive(pid):
+                con.execute("DELETE FROM tickets WHERE pid = ?", (pid,))
+
+        (running,) = con.execute(
+            "SELECT COUNT(*) FROM tickets WHERE state = 'running'"
+        ).fetchone()
+
+        # Round-robin over kernels: the n-th waiting job of every kernel comes
+        # before the (n+1)-th job of any kernel.
+        rank = collections.Counter()
+        order = []
+        for id_, pid in con.execute(
+            "SELECT id, pid FROM tickets WHERE state = 'waiting' ORDER BY id"
+        ):
+            order.append((rank[pid], id_))
+            rank[pid] += 1
+        order = [id_ for _, id_ in sorted(order)]
+        if ticket not in order:
+            # Removed from the queue (should not happen); run it anyway.
+            return 0
+
+        position = order.index(ticket)
+        free = self.max_jobs - running
+        if position < free:
+            con.execute("UPDATE tickets SET state = 'running' WHERE id = ?", (ticket,))
+            return 0
+        return position - free + 1
+
+    def _release(self, ticket):
+        try:
+            self._connect().execute("DELETE FROM tickets WHERE id = ?", (ticket,))
+        except sqlite3.Error:
+            # The ticket is removed once this process has exited.
+            logger.exception("Cannot release job %d in %s.", ticket, self.path)
+
+    def _wait(self, ticket, on_wait, stop):
+        last = None
+        while True:
+            position = self._poll(ticket)
+            if position == 0:
+                return
+            if on_wait is not None and position != last:
+                on_wait(position)
+                last = position
+            if stop is None:
+                time.sleep(self.poll_interval)
+            elif stop.wait(self.poll_interval):
+                raise JobCancelled()
+
+    @contextlib.contextmanager
+    def slot(self, name="job", on_wait=None, stop=None):
+        """
+        Wait for a free slot and hold it while the block runs.
+
+        Nested slots of the same thread do not wait again.
+
+        Parameters
+        ----------
+        name
+            Job name (for inspecting the queue).
+        on_wait
+            Optional callback receiving the queue position (starting at 1)
+            whenever it changes while waiting.
+        stop
+            Optional threading.Event. If set while waiting, the job leaves the
+            queue and JobCancelled is raised.
+        """
+        if not self.enabled or getattr(self._local, "held", False):
+            yield
+            return
+
+        start = time.perf_counter()
+        ticket = self._enqueue(name)
+        try:
+            if ticket is not None:
+                self._wait(ticket, on_wait, stop)
+            tracer.record("queue", start, job=name)
+            self._local.held = True
+            try:
+                yield
+            finally:
+                self._local.held = False
+        finally:
+            if ticket is not None:
+                self._release(ticket)
+
+    def status(self):
+        """
+        Return the number of running and waiting jobs on this node.
+        """
+        try:
+            rows = self._connect().execute(
+                "SELECT state, COUNT(*) FROM tickets GROUP BY state"
+            )
+            counts = dict(rows.fetchall())
+        except sqlite3.Error:
+            counts = {}
+        return {
+            "running": counts.get("running", 0),
+            "waiting": counts.get("waiting", 0),
+        }
+
+
+# Instantiate a single global scheduler object
+scheduler = Scheduler()
@@ -0,0 +1,204 @@
+"""Parallel screening of substituent patterns (Template → OptMin → UVVis)."""
+
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import io
+import traceback
+
+from . import azobenzene, common, optimization, symmetry, threads, uvvis
+
+# A pattern that crashed a worker process on its own is retried this often
+# before it is reported as failed.
+MAX_RETRIES = 1
+
+CRASH_ERROR = "Worker process terminated unexpectedly."
+
+# Results in the atom order of their pattern.
+PER_ATOM = ("numbers", "initial_positions", "positions")
+
+
+def screen(pattern, spectrum=True, conformers=False):
+    """
+    Run the screening pipeline for a single substituent pattern.
+
+    Parameters
+    ----------
+    pattern
+        Keyword arguments for Template, e.g. ``{"configuration": "cis", "r1c3": "F"}``.
+    spectrum
+        Whether to compute a UV-Vis spectrum of the optimized structure.
+    conformers
+        Whether to start the optimization from the best conformer of a
+        conformer search instead of the single embedded geometry.
+
+    Returns
+    -------
+    dict
+        The pattern together with the results. If any stage fails, the traceback
+        is stored under "error" and the remaining stages are skipped.
+    """
+    result = {"pattern": dict(pattern), "error": None}
+    try:
+        template = azobenzene.Template(**pattern)
+        if conformers:
+            # Already running in a worker process: rerank serially.
+            template.search_conformers(max_workers=1, num_threads=1)
+        result["initial_positions"] = template.atoms.get_positions()
+        opt = optimization.OptMin(template.atoms)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result["converged"] = opt.run()
+
+        properties = azobenzene.Properties(opt.atoms)
+        result["energy"] = properties.energy()
+        result["cnnc_dihedral"] = properties.cnnc_dihedral()
+        result["ring_distance"] = properties.ring_distance()
+        result["positions"] = opt.atoms.get_positions()
+        result["numbers"] = opt.atoms.get_atomic_numbers()
+
+        if spectrum:
+            uv_vis = uvvis.UVVis(opt.atoms)
+            with contextlib.redirect_stdout(io.StringIO()):
+                uv_vis.calculate()
+            result["excitations"] = uv_vis.excitations
+            result["oscillator_strengths"] = uv_vis.oscillator_strengths
+    except common.CALCULATION_ERRORS:
+        result["error"] = traceback.format_exc()
+    return result
+
+
+def _copy(result, source, pattern):
+    """
+    Return a copy of the result of pattern source for an equivalent pattern,
+    with per-atom results in the atom order of its Template.
+    """
+    result = {**result, "pattern": dict(pattern)}
+    names = [name for name in PER_ATOM if name in result]
+    if names and pattern != source:
+        perm = azobenzene.template_permutation(
+            pattern.get("configuration", "trans"),
+            [source.get(slot, "H") for slot in symmetry.SLOTS],
+            [pattern.get(slot, "H") for slot in symmetry.SLOTS],
+        )
+        for name in names:
+            result[name] = result[name][perm]
+    return result
+
+
+class ScreeningRunner:
+    """
+    Screen substituent patterns in a pool of single-threaded worker processes.
+    """
+
+    def __init__(self, max_workers=None, spectrum=True, conformers=False):
+        """
+        Parameters
+        ----------
+        max_workers
+            Number of worker processes (defaults to the available cores).
+        spectrum
+            Whether to compute UV-Vis spectra.
+        conformers
+            Whether to run a conformer search before each optimization.
+        """
+        self.max_workers = max_workers or threads.available_cpus()
+        self.spectrum = spectrum
+        self.conformers = conformers
+
+    def _executor(self):
+        return common.new_process_pool(self.max_workers)
+
+    def _submit(self, executor, pattern):
+        return executor.submit(screen, pattern, self.spectrum, self.conformers)
+
+    def run(self, patterns):
+        """
+        Screen patterns and yield results as soon as they are available.
+
+        Patterns may be a list or a (possibly long) generator; only a bounded
+        number of them is submitted at any time. Results are yielded in order
+        of completion, not in order of submission. Symmetry-equivalent
+        patterns (see symmetry.canonical) are computed only once, and each
+        of them receives a copy of the result (in its own atom order).
+
+        If a worker process dies (e.g. a crash in native code), the patterns
+        that were running are rerun one at a time in a fresh pool, so that
+        only the pattern causing the crash is reported as failed.
+        """
+        patterns = iter(patterns)
+        max_pending = 2 * self.max_workers
+
+        executor = self._executor()
+        pending = {}  # future -> canonical pattern
+        waiting = {}  # canonical pattern -> patterns waiting for its result
+        finished = {}  # canonical pattern -> computed pattern and result
+        suspects = collections.deque()  # patterns running when a worker died
+        crashes = collections.Counter()  # canonical pattern -> crashes alone
+        isolated = False
+        exhausted = False
+        try:
+            while True:
+                if suspects and not pending:
+                    # Rerun suspects alone, so that a crash is attributed to
+                    # the pattern that caused it.
+                    key = suspects.popleft()
+                    pending[self._submit(executor, waiting[key][0])] = key
+                    isolated = True
+                while (
+                    not suspects
+                    and not isolated
+                    and not exhausted
+                    and len(pending) < max_pending
+                ):
+                    pattern = next(patterns, None)
+                    if pattern is None:
+                        exhausted = True
+                        break
+                    key = symmetry.canonical_pattern(pattern)
+                    if key in finished:
+                        computed, result = finished[key]
+                        yield _copy(result, computed, pattern)
+                    elif key in waiting:
+                        waiting[key].append(pattern)
+                    else:
+                        waiting[key] = [pattern]
+                        pending[self._submit(executor, pattern)] = key
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                broken = False
+                for future in done:
+                    key = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        broken = True
+                        if isolated:
+                            crashes[key] += 1
+                        if not isolated or crashes[key] <= MAX_RETRIES:
+                            suspects.append(key)
+                            continue
+                        result = {"error": CRASH_ERROR}
+                    computed = waiting[key][0]
+                    finished[key] = (computed, result)
+                    for pattern in waiting.pop(key):
+                        yield _copy(result, computed, pattern)
+                isolated = False
+                if broken:
+                    # All remaining futures of the dead pool fail as well.
+                    suspects.extend(pending.values())
+                    pending.clear()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = self._executor()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def run_all(self, patterns):
+        """
+        Screen patterns and return all results as a list.
+        """
+        return list(self.run(patterns))
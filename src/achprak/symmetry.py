@@ -0,0 +1,108 @@
+"""Canonical representatives of symmetry-equivalent substitution patterns."""
+
+import itertools
+
+import rdkit.Chem
+
+# Template keyword arguments of the substituent positions, in order.
+SLOTS = tuple(f"r{ring}c{carbon}" for ring in (1, 2) for carbon in range(1, 6))
+
+# Both rings rotate freely about their C-N bond, which exchanges c1 with c5
+# and c2 with c4, and the two rings are equivalent. As permutations of the
+# slots (new[i] = old[perm[i]]):
+FLIP_RING1 = (4, 3, 2, 1, 0, 5, 6, 7, 8, 9)
+FLIP_RING2 = (0, 1, 2, 3, 4, 9, 8, 7, 6, 5)
+SWAP_RINGS = (5, 6, 7, 8, 9, 0, 1, 2, 3, 4)
+_GENERATORS = (FLIP_RING1, FLIP_RING2, SWAP_RINGS)
+
+
+def _compose(*perms):
+    result = tuple(range(len(SLOTS)))
+    for perm in perms:
+        result = tuple(result[i] for i in perm)
+    return result
+
+
+# The symmetry group of the substitution pattern (8 operations).
+OPERATIONS = tuple(
+    _compose(*[op for op, used in zip(_GENERATORS, flags) if used])
+    for flags in itertools.product((False, True), repeat=len(_GENERATORS))
+)
+
+
+def _order(substituents):
+    # Substituents are moved to the first slots (ring 1, then c1 to c5).
+    return tuple((sub == "H", sub) for sub in substituents)
+
+
+def canonical(configuration, substituents):
+    """
+    Return the canonical representative of a substitution pattern.
+
+    Parameters
+    ----------
+    configuration
+        Either "trans" or "cis".
+    substituents
+        Substituent names for r1c1, ..., r2c5.
+
+    Returns
+    -------
+    tuple
+        Configuration and canonical substituents (a tuple). Patterns describe
+        the same molecule if and only if their representatives are equal.
+    """
+    substituents = tuple(substituents)
+    equivalents = (tuple(substituents[i] for i in op) for op in OPERATIONS)
+    return configuration, min(equivalents, key=_order)
+
+
+def canonical_pattern(pattern):
+    """
+    Return the canonical representative of Template keyword arguments.
+    """
+    return canonical(
+        pattern.get("configuration", "trans"),
+        [pattern.get(slot, "H") for slot in SLOTS],
+    )
+
+
+def canonical_smiles(configuration, substituents):
+    """
+    Return the RDKit canonical SMILES of a substitution pattern.
+    """
+    from .azobenzene import template_smiles
+
+    mol = rdkit.Chem.MolFromSmiles(template_smiles(configuration, substituents))
+    return rdkit.Chem.MolToSmiles(mol)
+
+
+def verify(patterns):
+    """
+    Check the canonicalization against RDKit canonical SMILES.
+
+    Patterns with the same representative must have the same canonical
+    SMILES, and patterns with different representatives different ones.
+
+    Parameters
+    ----------
+    patterns
+        Iterable of Template keyword arguments.
+
+    Raises
+    ------
+    ValueError
+        If the canonicalization and RDKit disagree.
+    """
+    smiles_by_key = {}
+    key_by_smiles = {}
+    for pattern in patterns:
+        key = canonical_pattern(pattern)
+        smiles = canonical_smiles(
+            pattern.get("configuration", "trans"),
+            [pattern.get(slot, "H") for slot in SLOTS],
+        )
+        if smiles_by_key.setdefault(key, smiles) != smiles:
+            raise ValueError(f"{pattern} is not equivalent to {key}.")
+        if key_by_smiles.setdefault(smiles, key) != key:
+            raise ValueError(f"{key} and {key_by_smiles[smiles]} are equivalent.")
@@ -0,0 +1,143 @@
+"""Runtime thread allocation for tblite and MOPAC jobs."""
+
+import collections
+import contextlib
+import math
+import os
+import threading
+
+try:
+    import threadpoolctl
+except ImportError:  # Thread counts then only apply to MOPAC.
+    threadpoolctl = None
+
+from . import THREAD_VARIABLES
+
+# Upper bounds per job. For azobenzene-sized systems (20-50 atoms), tblite and
+# MOPAC stop scaling at a few threads (see `python -m achprak.benchmarks
+# threads`), so more threads are better spent on concurrent jobs.
+MAX_THREADS = {"tblite": 4, "mopac": 4}
+
+
+def cpu_quota():
+    """
+    Return the CPU quota of the cgroup of this process (in cores), or None.
+    """
+    # cgroup v2
+    with contextlib.suppress(OSError, ValueError):
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    # cgroup v1
+    with contextlib.suppress(OSError, ValueError):
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0:
+            return quota / period
+    return None
+
+
+def available_cpus():
+    """
+    Return the number of cores this process may use (affinity and quota).
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    quota = cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.floor(quota)))
+    return cpus
+
+
+def load():
+    """
+    Return the 1-minute load average of the node (0 if unavailable).
+    """
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return 0.0
+
+
+def job_threads(kind="tblite"):
+    """
+    Return the number of threads for a new job.
+
+    Idle cores (available cores minus the current load) are used up to
+    MAX_THREADS[kind]. On a busy node, jobs run single-threaded. The
+    environment variable ACHPRAK_THREADS overrides the policy.
+
+    Parameters
+    ----------
+    kind
+        Either "tblite" or "mopac".
+    """
+    threads = os.environ.get("ACHPRAK_THREADS")
+    if threads:
+        return max(1, int(threads))
+    idle = math.floor(available_cpus() - load())
+    return max(1, min(idle, MAX_THREADS[kind]))
+
+
+# Thread counts of the active limit blocks (count -> number of blocks), and
+# the limiter holding the original limits while any block is active.
+_active = collections.Counter()
+_active_lock = threading.Lock()
+_limiter = None
+
+
+def _apply():
+    global _limiter
+    if not _active:
+        if _limiter is not None:
+            _limiter.restore_original_limits()
+            _limiter = None
+        return
+    threads = min(_active)
+    if _limiter is None:
+        _limiter = threadpoolctl.threadpool_limits(limits=threads)
+    else:
+        threadpoolctl.threadpool_limits(limits=threads)
+
+
+@contextlib.contextmanager
+def limit(threads):
+    """
+    Set the number of OpenMP and BLAS threads of this process for a block.
+
+    The setting is process-wide, so blocks of tools running at the same time
+    (in different threads) share it: while any block is active, the smallest
+    requested count applies, and the original limits are restored when the
+    last block ends, regardless of the order in which blocks end.
+    """
+    if threadpoolctl is None:
+        yield
+        return
+    with _active_lock:
+        _active[threads] += 1
+        _apply()
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active[threads] -= 1
+            if not _active[threads]:
+                del _active[threads]
+            _apply()
+
+
+def environment(threads):
+    """
+    Return a copy of the environment for a subprocess (e.g. MOPAC) with the
+    given number of threads.
+    """
+    env = dict(os.environ)
+    for var in THREAD_VARIABLES:
+        env[var] = str(threads)
+    return env
@@ -0,0 +1,140 @@
+"""Molecular topology (bonds and bond orders) for ASE Atoms, with caching."""
+
+import collections
+import hashlib
+import threading
+
+import ase.data
+import numpy as np
+import rdkit.Chem
+import rdkit.Chem.rdDetermineBonds
+
+# Same criterion as RDKit's DetermineConnectivity: bonded if the distance is
+# below COV_FACTOR times the sum of the covalent radii.
+COV_FACTOR = 1.3
+
+CACHE_SIZE = 256
+
+
+def connectivity(numbers, positions, cov_factor=COV_FACTOR):
+    """
+    Return the bonded atom pairs (i < j) from interatomic distances.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    radii = ase.data.covalent_radii[np.asarray(numbers)]
+    distances = np.linalg.norm(positions[:, None, :] - positions[None, :, :], axis=-1)
+    cutoff = cov_factor * (radii[:, None] + radii[None, :])
+    i, j = np.nonzero(np.triu(distances < cutoff, k=1))
+    return np.stack([i, j], axis=1)
+
+
+def fingerprint(numbers, bonds, charge=0):
+    """
+    Hash atomic numbers, bonded pairs (in atom order) and the total charge.
+    """
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    bonds = np.sort(bonds, axis=1)
+    bonds = bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
+    h = hashlib.sha256()
+    h.update(np.asarray(numbers, dtype=np.int64).tobytes())
+    h.update(bonds.tobytes())
+    h.update(str(charge).encode())
+    return h.hexdigest()
+
+
+class TopologyCache:
+    """
+    Bounded LRU cache of RDKit molecules (without conformers and
+    stereochemistry), keyed by their connectivity fingerprint.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._mols = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            mol = self._mols.get(key)
+            if mol is not None:
+                self._mols.move_to_end(key)
+            return mol
+
+    def put(self, key, mol):
+        mol = rdkit.Chem.Mol(mol)
+        mol.RemoveAllConformers()
+        # Cis and trans isomers share their connectivity; the stereochemistry
+        # of one must not be put on structures of the other.
+        rdkit.Chem.RemoveStereochemistry(mol)
+        with self._lock:
+            self._mols[key] = mol
+            self._mols.move_to_end(key)
+            while len(self._mols) > self.size:
+                self._mols.popitem(last=False)
+
+
+# Instantiate a single global cache object
+topology_cache = TopologyCache()
+
+
+def register(mol, charge=0):
+    """
+    Make the topology of a molecule with known bond orders (e.g. Template.molh)
+    available to atoms_to_mol, so that its structures skip bond perception.
+    """
+    numbers = [atom.GetAtomicNum() for atom in mol.GetAtoms()]
+    bonds = [(b.GetBeginAtomIdx(), b.GetEndAtomIdx()) for b in mol.GetBonds()]
+    topology_cache.put(fingerprint(numbers, bonds, charge), mol)
+
+
+def _perceive(numbers, positions, bonds, charge):
+    """
+    Assign bond orders to a given connectivity.
+    """
+    mol = rdkit.Chem.RWMol()
+    for number in numbers:
+        atom = rdkit.Chem.Atom(int(number))
+        atom.SetNoImplicit(True)
+        mol.AddAtom(atom)
+    for i, j in bonds:
+        mol.AddBond(int(i), int(j), rdkit.Chem.BondType.SINGLE)
+    mol = mol.GetMol()
+    # DetermineBondOrders needs a conformer. Stereochemistry is not assigned,
+    # since the topology is shared by all structures with this connectivity
+    # (e.g. cis and trans isomers).
+    conf = rdkit.Chem.Conformer(len(numbers))
+    conf.SetPositions(np.asarray(positions, dtype=np.float64))
+    conf.Set3D(True)
+    mol.AddConformer(conf, assignId=True)
+    rdkit.Chem.rdDetermineBonds.DetermineBondOrders(
+        mol, charge=charge, embedChiral=False
+    )
+    rdkit.Chem.SanitizeMol(mol)
+    mol.RemoveAllConformers()
+    return mol
+
+
+def atoms_to_mol(atoms, charge=0):
+    """
+    Construct an RDKit Mol object (with bond orders) from an ASE Atoms object.
+
+    The connectivity is determined from distances. If a molecule with the same
+    connectivity was seen before, its topology is reused; otherwise, only the
+    bond orders are perceived.
+    """
+    numbers = atoms.get_atomic_numbers()
+    positions = atoms.get_positions()
+    bonds = connectivity(numbers, positions)
+    key = fingerprint(numbers, bonds, charge)
+
+    template = topology_cache.get(key)
+    if template is None:
+        template = _perceive(numbers, positions, bonds, charge)
+        topology_cache.put(key, template)
+
+    mol = rdkit.Chem.Mol(template)
+    conf = rdkit.Chem.Conformer(len(numbers))
+    conf.SetPositions(positions)
+    conf.Set3D(True)
+    mol.AddConformer(conf, assignId=True)
+    return mol
@@ -0,0 +1,249 @@
+"""Lightweight tracing of hot paths (timing spans and counters)."""
+
+import collections
+import contextlib
+import functools
+import html
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("ACHPRAK_TRACE", "0") != "0"
+
+# Oldest spans are dropped beyond this number.
+MAX_EVENTS = 100_000
+
+REFRESH_TEXT = "Aktualisieren  🔄"
+CLEAR_TEXT = "Zurücksetzen  🗑️"
+EXPORT_TEXT = "Exportieren  💾"
+EXPORT_OK_TEXT = "Exportiert ✅"
+EXPORT_ERROR_TEXT = "Fehler ❌"
+
+_null_span = contextlib.nullcontext()
+
+
+class Tracer:
+    """
+    Collects timing spans and counters of this process.
+
+    When disabled, spans and counters cost a single attribute lookup. Work done
+    in pool worker processes is not traced, only the submitting calls are.
+    """
+
+    def __init__(self, enabled=ENABLED, max_events=MAX_EVENTS):
+        self.enabled = enabled
+        self._events = collections.deque(maxlen=max_events)
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def record(self, name, start, end=None, **args):
+        """
+        Record a span that started at start (and ended at end or now), as
+        measured by time.perf_counter.
+        """
+        if not self.enabled:
+            return
+        if end is None:
+            end = time.perf_counter()
+        event = {
+            "name": name,
+            "start": start - self._origin,
+            "duration": end - start,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self._lock:
+            self._events.append(event)
+
+    def span(self, name, **args):
+        """
+        Return a context manager that records the time spent inside it.
+        """
+        if not self.enabled:
+            return _null_span
+        return self._span(name, args)
+
+    @contextlib.contextmanager
+    def _span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, **args)
+
+    def traced(self, name):
+        """
+        Decorator recording a span for every call of the decorated function.
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._span(name, {}):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, name, value=1):
+        """
+        Increment a counter.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] += value
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+            self._counters.clear()
+
+    def summary(self):
+        """
+        Return the number of calls and the total, mean and maximum time (in s)
+        per span name, sorted by total time.
+        """
+        stats = {}
+        for event in self.events():
+            s = stats.setdefault(event["name"], {"calls": 0, "total": 0.0, "max": 0.0})
+            s["calls"] += 1
+            s["total"] += event["duration"]
+            s["max"] = max(s["max"], event["duration"])
+        for s in stats.values():
+            s["mean"] = s["total"] / s["calls"]
+        return dict(sorted(stats.items(), key=lambda item: -item[1]["total"]))
+
+    def export_jsonl(self, path):
+        """
+        Write spans (and finally the counters) as JSON lines.
+        """
+        with open(path, "w") as f:
+            f.writelines(
+                json.dumps(event, default=str) + "\n" for event in self.events()
+            )
+            f.write(json.dumps({"counters": self.counters()}) + "\n")
+
+    def export_chrome(self, path):
+        """
+        Write spans and counters in the Chrome trace event format, which can
+        be opened with chrome://tracing or https://ui.perfetto.dev.
+        """
+        trace_events = [
+            {
+                "name": event["name"],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["duration"] * 1e6,
+                "pid": event["pid"],
+                "tid": event["tid"],
+                "args": event["args"],
+            }
+            for event in self.events()
+        ]
+        ts = (time.perf_counter() - self._origin) * 1e6
+        for name, value in self.counters().items():
+            trace_events.append(
+                {
+                    "name": name,
+                    "ph": "C",
+                    "ts": ts,
+                    "pid": os.getpid(),
+                    "args": {"value": value},
+                }
+            )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events}, f, default=str)
+
+
+# Instantiate a single global tracer object
+tracer = Tracer()
+
+
+class TracingTool:
+    """
+    Interactive summary of the recorded spans and counters.
+
+    The widget stack is only imported here, so that tracing itself stays
+    cheap to import in headless kernels and pool workers.
+    """
+
+    def __init__(self, path="achprak-trace.json"):
+        import ipywidgets
+
+        self.path = path
+
+        self._enabled_checkbox = ipywidgets.Checkbox(
+            value=tracer.enabled, description="Aufzeichnung aktiv"
+        )
+        self._enabled_checkbox.observe(self._on_change, names="value")
+
+        self._refresh_button = ipywidgets.Button(description=REFRESH_TEXT)
+        self._refresh_button.on_click(self._on_click)
+        self._clear_button = ipywidgets.Button(description=CLEAR_TEXT)
+        self._clear_button.on_click(self._on_click)
+        self._export_button = ipywidgets.Button(description=EXPORT_TEXT)
+        self._export_button.on_click(self._on_click)
+
+        self._table = ipywidgets.HTML()
+
+    def show(self):
+        import IPython.display
+        import ipywidgets
+
+        IPython.display.display(
+            self._enabled_checkbox,
+            ipywidgets.HBox(
+                [self._refresh_button, self._clear_button, self._export_button]
+            ),
+            self._table,
+        )
+        self._update()
+
+    def _on_change(self, change):
+        tracer.enabled = change["new"]
+
+    def _on_click(self, button):
+        from . import ui
+
+        if button is self._clear_button:
+            tracer.clear()
+        elif button is self._export_button:
+            try:
+                tracer.export_chrome(self.path)
+                ui.flash_button(button, message=EXPORT_OK_TEXT)
+            except OSError:
+                ui.flash_button(button, message=EXPORT_ERROR_TEXT)
+        self._update()
+
+    def _update(self):
+        rows = [
+            (
+                "<tr><th>Abschnitt</th><th>Aufrufe</th><th>Gesamt / s</th>"
+                "<th>Mittel / ms</th><th>Max / ms</th></tr>"
+            )
+        ]
+        for name, s in tracer.summary().items():
+            rows.append(
+                f"<tr><td>{html.escape(name)}</td><td>{s['calls']}</td>"
+                f"<td>{s['total']:.3f}</td><td>{s['mean'] * 1e3:.1f}</td>"
+                f"<td>{s['max'] * 1e3:.1f}</td></tr>"
+            )
+        rows.append("<tr><th>Zähler</th><th>Wert</th></tr>")
+        for name, value in sorted(tracer.counters().items()):
+            rows.append(f"<tr><td>{html.escape(name)}</td><td>{value}</td></tr>")
+        self._table.value = f"<table>{''.join(rows)}</table>"
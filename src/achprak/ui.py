@@ -1,8 +1,11 @@
 import asyncio
+import typing
 
 import IPython.display
 import ipywidgets as widgets
-import nglview
+
+if typing.TYPE_CHECKING:
+    import nglview
 
 
 class NGLAccordion:
@@ -26,12 +29,14 @@ class NGLAccordion:
 
         self.ngl_view: nglview.NGLWidget | None = None
         self._pending: tuple[str, object] | None = None
+        self._traj: object | None = None
 
     def show(self, output: widgets.Output) -> None:
         with output:
             IPython.display.display(self.accordion)
 
     def clear(self) -> None:
+        self._traj = None
         if self.ngl_view is None:
             self._pending = None
             return
@@ -46,6 +51,8 @@ class NGLAccordion:
             self._pending = ("atoms", atoms)
             return
 
+        import nglview
+
         self.clear()
         self.ngl_view.add_component(nglview.ASEStructure(atoms))
         self.ngl_view.center()
@@ -56,10 +63,31 @@ class NGLAccordion:
             self._pending = ("traj", traj)
             return
 
+        import nglview
+
         self.clear()
         self.ngl_view.add_trajectory(nglview.ASETrajectory(traj))
         self.ngl_view.center()
         self._resize()
+        self._traj = traj
+
+    def stream_traj(self, traj) -> None:
+        """
+        Show a trajectory that is still growing and jump to its newest frame.
+
+        Call again with the same list whenever frames have been appended; the
+        trajectory component is only created once.
+        """
+        if self.ngl_view is None:
+            self._pending = ("traj", traj)
+            return
+
+        if self._traj is not traj:
+            self.show_traj(traj)
+
+        last = len(traj) - 1
+        self.ngl_view.max_frame = last
+        self.ngl_view.frame = last
 
     def close(self) -> None:
         if self.ngl_view is not None:
@@ -80,6 +108,9 @@ class NGLAccordion:
             self._resize(delay=150)
             return
 
+        # nglview is slow to import, so defer it until a view is actually opened.
+        import nglview
+
         with self._slot:
             self._slot.clear_output(wait=True)
 
@@ -112,6 +143,31 @@ class NGLAccordion:
         )
 
 
+class OutputStream:
+    """
+    Minimal file-like object that appends text to an Output widget.
+
+    Unlike ``with output:``, this works reliably from background threads.
+    Text written after the optional stop event is set is dropped (e.g. the
+    remaining output of a job the user walked away from).
+    """
+
+    def __init__(self, output: widgets.Output, stop=None):
+        self.output = output
+        self.stop = stop
+
+    def write(self, text: str) -> int:
+        if text and (self.stop is None or not self.stop.is_set()):
+            self.output.append_stdout(text)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
 def flash_button(button, message: str, seconds: float = 0.5) -> None:
     """
     Temporarily change button label and disable it.
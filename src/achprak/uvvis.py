@@ -1,19 +1,47 @@
+import concurrent.futures
+import contextlib
+import functools
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+import ase.md.langevin
+import ase.md.velocitydistribution
+import ase.units
 import IPython.display
 import ipywidgets
+import matplotlib.figure
 import matplotlib.pyplot as plt
 import numpy as np
-import pymopac
 import scipy.constants as const
 
-from . import common
+from . import common, threads, ui
+from .broadening import broaden
+from .cache import make_key, result_cache
+from .library import LIBRARY_HIT_TEXT, library
+from .scheduler import JobCancelled, scheduler
+from .tracing import tracer
 
 MAX_MEMORY = 8000
 
+KEYWORDS = f"INDO CIS MAXCI=800 WRTCI=30 WRTCONF=0.2 EPS={common.SOLVENT_EPS}"
+
+MOPAC_EXECUTABLE = os.environ.get("ACHPRAK_MOPAC", "mopac")
+
+# Maximum number of MOPAC processes started by this kernel at the same time.
+MAX_MOPAC_JOBS = int(os.environ.get("ACHPRAK_MAX_MOPAC_JOBS", threads.available_cpus()))
+_mopac_slots = threading.BoundedSemaphore(MAX_MOPAC_JOBS)
+
 EMIN = 1.5
 EMAX = 5.5
 SIGMA = 0.3
 
 
+@tracer.traced("parse_mopac_excitations")
 def parse_mopac_excitations(fname):
     in_block = False
     lines = []
@@ -36,54 +64,176 @@ def parse_mopac_excitations(fname):
     return excitations, strengths
 
 
+def mopac_input(atoms, keywords=KEYWORDS):
+    """
+    Return a MOPAC input file (Cartesian coordinates, no optimization flags).
+    """
+    lines = [f"1SCF {keywords}", "achprak", ""]
+    for symbol, (x, y, z) in zip(atoms.get_chemical_symbols(), atoms.positions):
+        lines.append(f"{symbol:2s} {x:16.10f} {y:16.10f} {z:16.10f}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+@tracer.traced("run_mopac")
+def run_mopac(atoms, keywords=KEYWORDS, log=None, nthreads=None, cache=True):
+    """
+    Run a MOPAC excited state calculation and return excitations and strengths.
+
+    Every job runs in its own scratch directory, so that several jobs can run
+    at the same time. Parsed results are cached, keyed by the geometry and the
+    keyword string.
+
+    Parameters
+    ----------
+    atoms
+        ASE Atoms object.
+    keywords
+        MOPAC keywords.
+    log
+        Optional file-like object receiving the MOPAC output.
+    nthreads
+        Number of MOPAC threads (default: chosen by threads.job_threads).
+    cache
+        Whether to use the result cache. One-off structures (e.g. MD
+        snapshots) should bypass it, so that they do not evict useful entries.
+    """
+    if cache:
+        result = cached_mopac(atoms, keywords)
+        if result is not None:
+            return result
+
+    with _mopac_slots, tempfile.TemporaryDirectory(prefix="achprak-mopac-") as tmp:
+        with open(os.path.join(tmp, "job.mop"), "w") as f:
+            f.write(mopac_input(atoms, keywords))
+        with tracer.span("mopac"):
+            subprocess.run(
+                [MOPAC_EXECUTABLE, "job.mop"],
+                cwd=tmp,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                env=threads.environment(nthreads or threads.job_threads("mopac")),
+                check=True,
+            )
+        outpath = os.path.join(tmp, "job.out")
+        if log is not None:
+            with open(outpath) as f:
+                log.write(f.read())
+        excitations, strengths = parse_mopac_excitations(outpath)
+
+    if cache:
+        result_cache.put(
+            make_key("mopac", atoms, keywords=keywords),
+            excitations=excitations,
+            oscillator_strengths=strengths,
+        )
+    return excitations, strengths
+
+
+def cached_mopac(atoms, keywords=KEYWORDS):
+    """
+    Return the cached excitations and oscillator strengths of run_mopac, or
+    None if the structure has not been calculated yet.
+    """
+    entry = result_cache.get(make_key("mopac", atoms, keywords=keywords))
+    if entry is None:
+        return None
+    return entry["excitations"], entry["oscillator_strengths"]
+
+
+class MopacRunner:
+    """
+    Run MOPAC excited state calculations for many structures concurrently.
+    """
+
+    def __init__(self, max_workers=MAX_MOPAC_JOBS, keywords=KEYWORDS, cache=True):
+        self.keywords = keywords
+        self.cache = cache
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, atoms):
+        """
+        Schedule a calculation and return a future of (excitations, strengths).
+        """
+        # Concurrent jobs already use the cores, so each runs single-threaded.
+        return self._executor.submit(
+            run_mopac, atoms.copy(), self.keywords, nthreads=1, cache=self.cache
+        )
+
+    def map(self, atoms_list):
+        """
+        Calculate all structures and return their results in input order.
+        """
+        futures = [self.submit(atoms) for atoms in atoms_list]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
 class UVVis:
     """
     Compute a UV-Vis spectrum.
     """
 
-    def __init__(self, atoms):
+    def __init__(self, atoms, keywords=KEYWORDS):
         self.atoms = atoms
-        xyz = common.atoms_to_xyz(atoms)
-        self.mopac = pymopac.MopacInput(
-            xyz,
-            model=f"INDO CIS MAXCI=800 WRTCI=30 WRTCONF=0.2 EPS={common.SOLVENT_EPS}",
-            addHs=False,
-            preopt=False,
-            aux=False,
-            stream=True,
-        )
+        self.keywords = keywords
         self.excitations = None
         self.oscillator_strengths = None
 
-    def calculate(self):
-        self.mopac.run()
-        self.excitations, self.oscillator_strengths = parse_mopac_excitations(
-            self.mopac.outpath
+    def calculate(self, log=None):
+        """
+        Run MOPAC, writing its output to log (defaults to stdout).
+        """
+        self.excitations, self.oscillator_strengths = run_mopac(
+            self.atoms, self.keywords, log=log or sys.stdout
         )
 
     def spectrum(self):
-        energy = np.linspace(EMIN, EMAX, 1000)
-        spectrum = np.zeros_like(energy)
-
-        for e, f in zip(self.excitations, self.oscillator_strengths):
-            spectrum += f * common.gaussian(x=energy, mu=e, sigma=SIGMA)
-
-        # Normalize, so that isolated peaks have the same height as the oscillator strength.
-        spectrum *= np.sqrt(2.0 * np.pi) * SIGMA
-
-        return energy, spectrum
+        # Isolated peaks have the same height as the oscillator strength.
+        energy, spectra = broaden(
+            [self.excitations],
+            [self.oscillator_strengths],
+            grid=np.linspace(EMIN, EMAX, 1000),
+            sigma=SIGMA,
+        )
+        return energy, spectra[0]
 
-    def plot(self, ax):
+    def plot(self, ax=None):
         """
         Plot the UV-Vis spectrum.
+
+        Parameters
+        ----------
+        ax
+            Matplotlib axes to draw on. By default, a new standalone figure is
+            created.
+
+        Returns
+        -------
+        matplotlib.axes.Axes
+            The axes drawn on.
         """
-        energy, spectrum = self.spectrum()
+        with plt.style.context(common.PLOT_STYLE):
+            if ax is None:
+                ax = matplotlib.figure.Figure().subplots()
+            energy, spectrum = self.spectrum()
 
-        ax.plot(energy, spectrum, color="C0")
+            ax.plot(energy, spectrum, color="C0")
 
-        for e, f in zip(self.excitations, self.oscillator_strengths):
-            if EMIN < e < EMAX:
-                ax.plot([e, e], [0, f], color="C1")
+            excitations = np.asarray(self.excitations)
+            strengths = np.asarray(self.oscillator_strengths)
+            visible = (EMIN < excitations) & (excitations < EMAX)
+            ax.vlines(excitations[visible], 0.0, strengths[visible], color="C1")
+
+            for e, f in zip(excitations[visible], strengths[visible]):
                 if f > 0.15:
                     ax.text(
                         e,
@@ -95,20 +245,219 @@ class UVVis:
                         rotation=45,
                     )
 
-        ax.set_xlim(EMIN, EMAX)
-        ax.set_ylim(0.0, 1.15 * np.max(spectrum))
-        ax.set_xlabel("Energie / eV")
-        ax.set_ylabel("Absorption / a.u.")
+            _decorate(ax, spectrum)
+        return ax
+
+
+class EnsembleUVVis:
+    """
+    Compute a thermally averaged UV-Vis spectrum from Langevin MD snapshots.
+
+    The MD runs in this thread, while the snapshots are calculated by MOPAC in
+    parallel. The average is updated as results come in, and sampling stops
+    once it changes by less than tol between successive checks.
+    """
+
+    def __init__(
+        self,
+        atoms,
+        temperature=300.0,
+        timestep=1.0,
+        friction=0.01,
+        equilibration=200,
+        stride=20,
+        min_samples=10,
+        max_samples=200,
+        window=5,
+        tol=0.02,
+        calc=None,
+        max_workers=MAX_MOPAC_JOBS,
+        keywords=KEYWORDS,
+    ):
+        """
+        Parameters
+        ----------
+        atoms
+            Starting structure (not modified).
+        temperature
+            Temperature in K.
+        timestep
+            MD time step in fs.
+        friction
+            Langevin friction in 1/fs.
+        equilibration
+            Number of MD steps before the first snapshot.
+        stride
+            Number of MD steps between snapshots.
+        min_samples, max_samples
+            Minimum and maximum number of snapshots.
+        window
+            Number of samples between convergence checks.
+        tol
+            Convergence threshold for the maximum change of the averaged
+            spectrum, relative to its maximum.
+        calc
+            ASE calculator for the MD (defaults to a pooled DefaultASECalculator).
+        max_workers
+            Number of concurrent MOPAC jobs.
+        keywords
+            MOPAC keywords.
+        """
+        self.atoms = atoms.copy()
+        self.atoms.calc = calc or common.pooled_calculator()
+        self.temperature = temperature
+        self.timestep = timestep
+        self.friction = friction
+        self.equilibration = equilibration
+        self.stride = stride
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.window = window
+        self.tol = tol
+        self.max_workers = max_workers
+        self.keywords = keywords
+
+        self.energy = np.linspace(EMIN, EMAX, 1000)
+        self.excitations = []
+        self.oscillator_strengths = []
+        self.history = []  # (number of samples, relative change)
+        self.converged = False
+        self._sum = np.zeros_like(self.energy)
+        self._checkpoint = None
+
+    def _add(self, excitations, strengths):
+        self.excitations.append(excitations)
+        self.oscillator_strengths.append(strengths)
+        _, spectra = broaden([excitations], [strengths], grid=self.energy, sigma=SIGMA)
+        self._sum += spectra[0]
+
+        n = len(self.excitations)
+        if n % self.window == 0:
+            mean = self._sum / n
+            if self._checkpoint is not None:
+                change = np.max(np.abs(mean - self._checkpoint)) / max(
+                    np.max(mean), np.finfo(float).tiny
+                )
+                self.history.append((n, change))
+                if n >= self.min_samples and change < self.tol:
+                    self.converged = True
+            self._checkpoint = mean
+
+    def run(self, callback=None):
+        """
+        Sample snapshots until the averaged spectrum is converged.
+
+        Parameters
+        ----------
+        callback
+            Optional function called as callback(self) after every new sample,
+            e.g. to update a plot.
+
+        Returns
+        -------
+        bool
+            Whether the average converged within max_samples.
+        """
+        md = ase.md.langevin.Langevin(
+            self.atoms,
+            timestep=self.timestep * ase.units.fs,
+            temperature_K=self.temperature,
+            friction=self.friction / ase.units.fs,
+        )
+        ase.md.velocitydistribution.MaxwellBoltzmannDistribution(
+            self.atoms, temperature_K=self.temperature
+        )
+
+        def collect(futures, block):
+            timeout = None if block else 0
+            done, _ = concurrent.futures.wait(
+                futures,
+                timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                futures.remove(future)
+                self._add(*future.result())
+                if callback is not None:
+                    callback(self)
+
+        with (
+            # Snapshots are never computed twice, so they bypass the cache.
+            MopacRunner(
+                max_workers=self.max_workers, keywords=self.keywords, cache=False
+            ) as runner,
+            contextlib.redirect_stdout(io.StringIO()),
+        ):
+            md.run(self.equilibration)
+            futures = set()
+            submitted = 0
+            while not self.converged:
+                if submitted < self.max_samples:
+                    # Keep the MOPAC workers busy while the MD continues.
+                    if len(futures) >= 2 * self.max_workers:
+                        collect(futures, block=True)
+                        continue
+                    md.run(self.stride)
+                    futures.add(runner.submit(self.atoms))
+                    submitted += 1
+                    collect(futures, block=False)
+                elif futures:
+                    collect(futures, block=True)
+                else:
+                    break
+            for future in futures:
+                future.cancel()
+
+        return self.converged
+
+    def spectrum(self):
+        """
+        Return the energy grid and the averaged spectrum.
+        """
+        return self.energy, self._sum / max(len(self.excitations), 1)
 
-        axw = plt.twiny()
-        hc = const.Planck * const.speed_of_light / (const.electron_volt * const.nano)
-        wmin = np.round(hc / EMIN, decimals=-2)
-        wmax = np.round(hc / EMAX, decimals=-2)
-        wticks = np.linspace(wmin, wmax, 9, dtype=np.int64)
-        axw.set_xlim(EMIN, EMAX)
-        axw.set_xticks(hc / wticks, wticks, rotation=45)
-        axw.grid(False)
-        axw.set_xlabel("Wellenlänge / nm")
+    def plot(self, ax=None):
+        """
+        Plot the averaged UV-Vis spectrum.
+
+        Parameters
+        ----------
+        ax
+            Matplotlib axes to draw on. By default, a new standalone figure is
+            created.
+
+        Returns
+        -------
+        matplotlib.axes.Axes
+            The axes drawn on.
+        """
+        with plt.style.context(common.PLOT_STYLE):
+            if ax is None:
+                ax = matplotlib.figure.Figure().subplots()
+            energy, spectrum = self.spectrum()
+            ax.plot(energy, spectrum, color="C0")
+            _decorate(ax, spectrum)
+        return ax
+
+
+def _decorate(ax, spectrum):
+    """
+    Set limits and labels, and add a wavelength axis on top.
+    """
+    ax.set_xlim(EMIN, EMAX)
+    ax.set_ylim(0.0, 1.15 * np.max(spectrum))
+    ax.set_xlabel("Energie / eV")
+    ax.set_ylabel("Absorption / a.u.")
+
+    axw = ax.twiny()
+    hc = const.Planck * const.speed_of_light / (const.electron_volt * const.nano)
+    wmin = np.round(hc / EMIN, decimals=-2)
+    wmax = np.round(hc / EMAX, decimals=-2)
+    wticks = np.linspace(wmin, wmax, 9, dtype=np.int64)
+    axw.set_xlim(EMIN, EMAX)
+    axw.set_xticks(hc / wticks, wticks, rotation=45)
+    axw.grid(False)
+    axw.set_xlabel("Wellenlänge / nm")
 
 
 class UVVisTool:
@@ -119,6 +468,11 @@ class UVVisTool:
     def __init__(self):
         self.atoms = None
         self.uv_vis = None
+        # Background worker, its cancellation flag, and a lock so that a
+        # reset does not interleave with the worker reporting its outcome.
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
 
         # Output widgets and friends.
         self._xyz_init_output = ipywidgets.Output()
@@ -164,16 +518,29 @@ class UVVisTool:
             if self.atoms is not None:
                 self._run_button.disabled = False
         elif button is self._run_button:
-            self._run_button.disabled = True
-            self._run_button.description = common.RUN_RUNNING_TEXT
-            self._run()
-            self._run_button.description = common.RUN_OK_TEXT
-            self._update()
+            if self._thread is not None:
+                # The run button doubles as a cancel button while queued.
+                self._stop.set()
+                self._run_button.disabled = True
+                self._run_button.description = common.RUN_CANCELLING_TEXT
+            elif self._serve():
+                self._run_button.disabled = True
+                self._run_button.description = common.RUN_OK_TEXT
+                self._update()
+            else:
+                self._start()
+
+    def _on_queue(self, stop, position):
+        if not stop.is_set():
+            self._run_button.description = common.RUN_QUEUED_TEXT.format(
+                position=position
+            )
 
     def _reset(self):
         """
         Reset the tool.
         """
+        self._cancel()
         self._xyz_init_output.clear_output()
         self._run_output.clear_output()
         self._absorption_output.clear_output()
@@ -183,16 +550,100 @@ class UVVisTool:
         self._run_button.disabled = True
         self._run_button.description = common.RUN_START_TEXT
 
-    def _run(self):
+    def _serve(self):
         """
-        Run the calculation.
+        Take the spectrum from the substituent library or the result cache, if
+        available, so that known structures do not wait in the queue.
         """
-        with self._run_output:
-            self.uv_vis = UVVis(self.atoms)
-            self.uv_vis.calculate()
+        self.uv_vis = UVVis(self.atoms)
+        result = None
+        if library.compatible(keywords=self.uv_vis.keywords):
+            entry = library.find(self.atoms, exact=True)
+            if entry is not None:
+                result = entry["excitations"], entry["oscillator_strengths"]
+                with self._run_output:
+                    print(LIBRARY_HIT_TEXT)
+        if result is None:
+            result = cached_mopac(self.atoms, self.uv_vis.keywords)
+        if result is None:
+            return False
+        self.uv_vis.excitations, self.uv_vis.oscillator_strengths = result
+        return True
+
+    def _start(self):
+        """
+        Start the calculation in a background thread.
+        """
+        self._stop = threading.Event()
+        self._run_button.description = common.RUN_CANCEL_TEXT
+        self._thread = threading.Thread(
+            target=self._work, args=(self._stop, self.uv_vis), daemon=True
+        )
+        self._thread.start()
+
+    def _cancel(self):
+        """
+        Leave the queue and detach the worker.
+
+        The worker is not waited for, since MOPAC cannot be interrupted. It
+        finishes on its own, and its result is dropped.
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._stop.set()
+                self._thread = None
+
+    def _work(self, stop, uv_vis):
+        """
+        Worker thread: wait for a free slot, then run MOPAC, and report the
+        outcome unless the tool was reset in the meantime.
+        """
+        error = message = None
+        try:
+            on_wait = functools.partial(self._on_queue, stop)
+            with scheduler.slot("UVVisTool", on_wait=on_wait, stop=stop):
+                if stop.is_set():
+                    raise JobCancelled()
+                with self._lock:
+                    if self._thread is threading.current_thread():
+                        # MOPAC cannot be interrupted.
+                        self._run_button.disabled = True
+                        self._run_button.description = common.RUN_RUNNING_TEXT
+                # Output widgets cannot be used as context managers from a
+                # background thread, so the program output is appended to the
+                # widget directly.
+                uv_vis.calculate(log=ui.OutputStream(self._run_output, stop=stop))
+        except JobCancelled as e:
+            error = e
+        except common.CALCULATION_ERRORS as e:
+            error = e
+            message = traceback.format_exc()
+        except BaseException:
+            # Bugs are reported like any other exception in a thread.
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._run_button.description = common.RUN_ERROR_TEXT
+                    self._thread = None
+            raise
+
+        with self._lock:
+            if self._thread is not threading.current_thread():
+                return
+            self._thread = None
+            if isinstance(error, JobCancelled):
+                self._run_output.append_stdout("Abgebrochen.\n")
+                self._run_button.description = common.RUN_START_TEXT
+                self._run_button.disabled = False
+            elif error is not None:
+                self._run_output.append_stderr(message)
+                self._run_button.description = common.RUN_ERROR_TEXT
+            else:
+                self._run_button.description = common.RUN_OK_TEXT
+                self._update()
 
     def _update(self):
-        with self._absorption_output:
-            fig, ax = plt.subplots()
-            self.uv_vis.plot(ax)
-            plt.show()
+        # A standalone figure (rather than pyplot) can be drawn from the worker
+        # thread and is not shown a second time at the end of the next cell.
+        fig = self.uv_vis.plot().figure
+        self._absorption_output.clear_output()
+        self._absorption_output.append_display_data(fig)
@@ -0,0 +1,164 @@
+"""Finite-difference vibrational analysis with displacements spread over processes."""
+
+import contextlib
+import io
+
+import ase
+import ase.vibrations
+import numpy as np
+
+from . import common, threads
+from .tracing import tracer
+
+DELTA = 0.01  # Å
+
+
+def _displaced_forces(numbers, positions, displacements, parameters):
+    """
+    Worker: compute forces for a chunk of displaced geometries.
+
+    The pooled calculator of this process is used, so that every SCC within
+    the chunk starts from the converged wavefunction of the previous (nearby)
+    geometry. The first one starts from scratch (or from whatever this worker
+    computed before, if it is close enough), not from the wavefunction of the
+    equilibrium structure in the kernel.
+    """
+    solvation = parameters.get("solvation")
+    atoms = ase.Atoms(numbers=numbers, positions=positions)
+    atoms.calc = common.pooled_calculator(
+        method=parameters.get("method", "GFN1-xTB"),
+        solvation=None if solvation is None else tuple(solvation),
+        accuracy=parameters.get("accuracy", 1.0),
+    )
+    forces = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for atom, axis, step in displacements:
+            atoms.positions[:] = positions
+            atoms.positions[atom, axis] += step
+            forces.append(atoms.get_forces())
+    return np.array(forces)
+
+
+class ParallelVibrations:
+    """
+    Finite-difference vibrations (central differences) evaluated in parallel.
+
+    The interface follows ase.vibrations.Vibrations, but all displaced force
+    calls are independent and distributed over a process pool. Nothing is
+    written to disk; the mode trajectory is returned as a list of Atoms.
+    """
+
+    def __init__(self, atoms, indices=None, delta=DELTA, max_workers=None):
+        """
+        Parameters
+        ----------
+        atoms
+            Equilibrium (or saddle point) structure with a TBLite calculator.
+        indices
+            Atoms to displace. Defaults to all atoms (full Hessian, suitable for
+            thermochemistry).
+        delta
+            Displacement step in Å.
+        max_workers
+            Number of processes to use. With 1, the displacements are evaluated
+            in this process with the attached calculator, which already holds
+            the converged wavefunction of the equilibrium structure, so that
+            every SCC starts from it. Otherwise (None uses the shared process
+            pool), each worker starts its chunk from scratch. Few displacements
+            (e.g. a partial Hessian) are best run with 1.
+        """
+        self.atoms = atoms
+        self.indices = list(range(len(atoms)) if indices is None else indices)
+        self.delta = delta
+        self.max_workers = max_workers
+        self.data = None
+
+    def _displacements(self):
+        return [
+            (atom, axis, sign * self.delta)
+            for atom in self.indices
+            for axis in range(3)
+            for sign in (1, -1)
+        ]
+
+    def _forces_serial(self, displacements):
+        positions = self.atoms.get_positions()
+        forces = []
+        with (
+            contextlib.redirect_stdout(io.StringIO()),
+            threads.limit(threads.job_threads("tblite")),
+        ):
+            try:
+                for atom, axis, step in displacements:
+                    self.atoms.positions[:] = positions
+                    self.atoms.positions[atom, axis] += step
+                    with tracer.span("displacement"):
+                        forces.append(self.atoms.get_forces())
+            finally:
+                self.atoms.positions[:] = positions
+        return np.array(forces)
+
+    def _forces_parallel(self, displacements):
+        numbers = self.atoms.get_atomic_numbers()
+        positions = self.atoms.get_positions()
+        parameters = dict(self.atoms.calc.parameters)
+
+        with common.process_pool(self.max_workers) as (pool, nworkers):
+            # Consecutive displacements stay within a chunk, so that each worker
+            # walks through nearby geometries.
+            chunks = [
+                chunk
+                for chunk in np.array_split(np.arange(len(displacements)), nworkers)
+                if len(chunk) > 0
+            ]
+            futures = [
+                pool.submit(
+                    _displaced_forces,
+                    numbers,
+                    positions,
+                    [displacements[i] for i in chunk],
+                    parameters,
+                )
+                for chunk in chunks
+            ]
+            return np.concatenate([future.result() for future in futures])
+
+    @tracer.traced("ParallelVibrations.run")
+    def run(self):
+        """
+        Compute the (partial) Hessian by central finite differences.
+        """
+        displacements = self._displacements()
+        tracer.count("vibrations.displacements", len(displacements))
+        if self.max_workers == 1:
+            forces = self._forces_serial(displacements)
+        else:
+            forces = self._forces_parallel(displacements)
+
+        # Row k of the Hessian is -dF/dx_k, restricted to the displaced atoms.
+        forces = forces[:, self.indices, :].reshape(len(displacements), -1)
+        hessian = -(forces[0::2] - forces[1::2]) / (2.0 * self.delta)
+        hessian = 0.5 * (hessian + hessian.T)
+
+        self.data = ase.vibrations.VibrationsData.from_2d(
+            self.atoms, hessian, indices=self.indices
+        )
+        return self.data
+
+    def get_frequencies(self):
+        """
+        Return the vibrational frequencies in cm^-1 (imaginary as complex).
+        """
+        return self.data.get_frequencies()
+
+    def get_zero_point_energy(self):
+        """
+        Return the zero-point energy in eV (only meaningful for a full Hessian).
+        """
+        return self.data.get_zero_point_energy()
+
+    def mode_traj(self, mode=0, nimages=60, kT=1.0):
+        """
+        Return an animation of a normal mode as a list of Atoms.
+        """
+        return list(self.data.iter_animated_mode(mode, temperature=kT, frames=nimages))
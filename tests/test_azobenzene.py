@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from achprak import azobenzene, cache
+from achprak.azobenzene import Template, template_permutation, template_smiles
+
+
+def _shared_rmsd(template, reference):
+    """
+    RMSD of the atoms shared with reference, without superimposing them again.
+    """
+    atom_map = template._atom_map(reference)
+    positions = template.atoms.get_positions()
+    ref_positions = reference.atoms.get_positions()
+    diff = positions[[i for i, _ in atom_map]] - ref_positions[[j for _, j in atom_map]]
+    return np.sqrt(np.mean(np.sum(diff**2, axis=1)))
+
+
+@pytest.mark.parametrize(
+    "substituent", [{"r1c3": "F"}, {"r2c2": "OMe"}, {"r1c1": "Me"}]
+)
+def test_incremental_embedding_keeps_unchanged_atoms(substituent):
+    Template._cache.clear()
+    reference = Template()
+    template = Template(**substituent, reference=reference)
+
+    assert len(template._atom_map(reference)) == len(reference.atoms) - 1
+    assert _shared_rmsd(template, reference) < 1e-6
+    # The new atoms were placed sensibly (no clashes).
+    distances = template.atoms.get_all_distances()
+    assert distances[np.triu_indices(len(distances), k=1)].min() > 0.8
+
+
+def test_substituents_stay_where_they_were_chosen():
+    Template._cache.clear()
+    reference = Template(r1c3="F")
+    # The canonical pattern of this one has the F on the second ring.
+    template = Template(r1c3="F", r2c1="SO2CF3", reference=reference)
+
+    assert template.smiles == template_smiles("trans", template.substituents)
+    assert len(template._atom_map(reference)) == len(reference.atoms) - 1
+    assert _shared_rmsd(template, reference) < 1e-6
+
+
+def test_template_permutation_maps_equivalent_templates():
+    source = Template(r1c1="Me", r2c2="F")
+    target = Template(r1c4="F", r2c5="Me")
+    perm = template_permutation("trans", source.substituents, target.substituents)
+
+    np.testing.assert_array_equal(
+        source.atoms.get_atomic_numbers()[perm], target.atoms.get_atomic_numbers()
+    )
+    source_bonds = {
+        frozenset((b.GetBeginAtomIdx(), b.GetEndAtomIdx()))
+        for b in source.molh.GetBonds()
+    }
+    for bond in target.molh.GetBonds():
+        i, j = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
+        assert frozenset((perm[i], perm[j])) in source_bonds
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError("Batch frames must not be cached.")
+
+
+def test_batch_properties_in_pool_match_serial(monkeypatch):
+    # Batch frames bypass the result cache.
+    monkeypatch.setattr(cache.result_cache, "put", _fail)
+
+    template = Template(r1c3="F")
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(4):
+        atoms = template.atoms.copy()
+        atoms.positions += rng.normal(scale=0.02, size=atoms.positions.shape)
+        images.append(atoms)
+
+    serial = azobenzene.batch_properties(images, max_workers=1)
+    pooled = azobenzene.batch_properties(images, max_workers=2)
+
+    # SCCs start from different wavefunctions at chunk boundaries, so results
+    # agree to within the SCC convergence (accuracy=1).
+    np.testing.assert_allclose(pooled["energy"], serial["energy"], atol=1e-4)
+    np.testing.assert_allclose(pooled["forces"], serial["forces"], atol=1e-3)
+    for name in ("cnnc_dihedral", "ring_distance"):
+        np.testing.assert_allclose(pooled[name], serial[name])
@@ -0,0 +1,23 @@
+import numpy as np  # noqa: F401 (loads a BLAS thread pool)
+import threadpoolctl
+
+from achprak import threads
+
+
+def _num_threads():
+    return [info["num_threads"] for info in threadpoolctl.threadpool_info()]
+
+
+def test_limit_restores_original_limits_in_any_order():
+    original = _num_threads()
+    a = threads.limit(4)
+    b = threads.limit(2)
+    a.__enter__()
+    b.__enter__()
+    assert all(n <= 2 for n in _num_threads())
+
+    # The first block ends first; the second one must keep its limit.
+    a.__exit__(None, None, None)
+    assert all(n <= 2 for n in _num_threads())
+    b.__exit__(None, None, None)
+    assert _num_threads() == original
@@ -0,0 +1,55 @@
+import ase
+import ase.build
+import pytest
+import rdkit.Chem
+
+from achprak import topology
+from achprak.azobenzene import Template
+
+
+@pytest.fixture
+def empty_topology_cache(monkeypatch):
+    monkeypatch.setattr(topology, "topology_cache", topology.TopologyCache())
+
+
+def test_perceive_unregistered_structure(empty_topology_cache):
+    atoms = ase.build.molecule("C6H6")
+    mol = topology.atoms_to_mol(atoms)
+
+    assert mol.GetNumAtoms() == len(atoms)
+    assert mol.GetNumConformers() == 1
+    assert sum(atom.GetIsAromatic() for atom in mol.GetAtoms()) == 6
+
+
+def test_perceive_unregistered_azobenzene(monkeypatch):
+    # Templates register their topology, so empty the cache afterwards.
+    template = Template()
+    monkeypatch.setattr(topology, "topology_cache", topology.TopologyCache())
+    atoms = ase.Atoms(
+        numbers=template.atoms.get_atomic_numbers(),
+        positions=template.atoms.get_positions(),
+    )
+    mol = topology.atoms_to_mol(atoms)
+
+    double = [
+        bond
+        for bond in mol.GetBonds()
+        if bond.GetBondType().name == "DOUBLE"
+        and bond.GetBeginAtom().GetSymbol() == "N"
+        and bond.GetEndAtom().GetSymbol() == "N"
+    ]
+    assert len(double) == 1
+
+
+def test_registered_topology_has_no_stereochemistry(monkeypatch):
+    # Templates register their topology, so empty the cache first.
+    monkeypatch.setattr(topology, "topology_cache", topology.TopologyCache())
+    trans = Template(configuration="trans")
+    cis = Template(configuration="cis")
+    topology.register(trans.molh)
+
+    mol = topology.atoms_to_mol(cis.atoms)
+
+    assert mol.GetNumConformers() == 1
+    for bond in mol.GetBonds():
+        assert bond.GetStereo() == rdkit.Chem.BondStereo.STEREONONE